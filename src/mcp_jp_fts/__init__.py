@@ -1,3 +1,9 @@
-from .server import main
+def main():
+    # Imported on call: indexing worker processes import this package too, and
+    # must not load the server (see documents.py)
+    from .server import main
+
+    main()
+
 
 __all__ = ["main"]
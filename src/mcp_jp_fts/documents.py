@@ -0,0 +1,386 @@
+"""
+Reading and tokenizing documents for the index.
+
+index_directory's worker processes import only this module, so it must not import
+the server (FastMCP, watchdog, the log listener) or anything else heavy besides
+the Sudachi dictionary.
+"""
+
+import array
+import codecs
+import hashlib
+import itertools
+import logging
+import operator
+import os
+import struct
+import sys
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from sudachipy import dictionary, tokenizer
+
+# The server configures this logger; in worker processes records go to stderr.
+logger = logging.getLogger("mcp_jp_fts")
+
+# SudachiPy Initialization
+# split_mode="A" for high recall (Shortest unit) as requested
+# The dictionary is shared; a Tokenizer must not be used from several threads at once,
+# so each thread (tool calls, watcher) and indexing worker process gets its own via get_tokenizer().
+sudachi_dictionary = dictionary.Dictionary()
+mode = tokenizer.Tokenizer.SplitMode.A
+_tokenizer_local = threading.local()
+
+
+def get_tokenizer():
+    """Return the SudachiPy tokenizer owned by the current thread."""
+    tok = getattr(_tokenizer_local, "tokenizer", None)
+    if tok is None:
+        # The split mode is fixed at creation instead of being passed per call. All
+        # word-info fields stay loaded: with only split_a, Sudachi stops joining numbers
+        # ("2024" becomes "2", "0", "2", "4").
+        tok = sudachi_dictionary.tokenizer(mode)
+        _tokenizer_local.tokenizer = tok
+    return tok
+
+
+# SudachiPy rejects inputs longer than this many UTF-8 bytes.
+SUDACHI_MAX_INPUT_BYTES = 49149
+# UTF-8 uses at most 4 bytes per character, so a window of this many
+# characters always fits into a single tokenizer call.
+TOKENIZE_CHUNK_CHARS = SUDACHI_MAX_INPUT_BYTES // 4
+
+
+def tokenize_chunks(text: str) -> Iterator[str]:
+    """
+    Split text into windows that fit SudachiPy's input limit.
+    Windows end on a newline boundary whenever one is available.
+    """
+    start = 0
+    length = len(text)
+    while start < length:
+        # ASCII windows are one byte per character and can use the whole limit,
+        # which keeps source files and logs to a few large tokenizer calls.
+        end = start + SUDACHI_MAX_INPUT_BYTES
+        if not text[start:end].isascii():
+            end = start + TOKENIZE_CHUNK_CHARS
+        if end >= length:
+            end = length
+        else:
+            newline = text.rfind("\n", start, end)
+            if newline != -1:
+                end = newline + 1
+        yield text[start:end]
+        start = end
+
+
+def tokenize(text: str) -> List[Tuple[str, int]]:
+    """
+    Tokenize text using SudachiPy and return list of (surface, byte_offset) tuples.
+    """
+    return _tokenize_windows(tokenize_chunks(text))
+
+
+def tokenize_file(
+    file_path: str, line_ends: Optional[List[int]] = None, digest=None
+) -> List[Tuple[str, int]]:
+    """
+    Like tokenize(read_text_file(file_path)), but the file is decoded and tokenized
+    piece by piece, so the whole text is never held in memory at once.
+    If line_ends is given, the byte offset just past each newline is appended to it.
+    If digest (a hashlib object) is given, it is updated with the bytes read.
+    Raises UnicodeDecodeError for binary/non-utf8 files.
+    """
+    return _tokenize_windows(
+        (
+            window
+            for piece in iter_text_file(file_path, digest)
+            for window in tokenize_chunks(piece)
+        ),
+        line_ends,
+    )
+
+
+_PLUS_ONE = (1).__add__
+
+
+def _record_line_ends(line_ends: List[int], parts: list, base: int):
+    """Append the offsets just past each newline, given the lengths of the parts between them."""
+    # Running sum of (part length + 1 for the newline), computed in C
+    ends = itertools.accumulate(map(_PLUS_ONE, map(len, parts)), initial=base)
+    line_ends.extend(itertools.islice(ends, 1, len(parts)))
+
+
+def _tokenize_windows(
+    windows: Iterable[str], line_ends: Optional[List[int]] = None
+) -> List[Tuple[str, int]]:
+    """Tokenize consecutive windows of one text, with byte offsets relative to its start."""
+    # SudachiPy returns character offsets (m.begin()) relative to each chunk.
+    # We need UTF-8 byte offsets relative to the whole text for file seeking and FTS mapping.
+    tokenizer_obj = get_tokenizer()
+    results = []
+    append = results.append
+    chunk_byte_offset = 0
+
+    for chunk in windows:
+        # ASCII fast path: byte offsets equal character offsets, nothing to encode
+        if chunk.isascii():
+            results.extend(
+                [
+                    (m.surface(), chunk_byte_offset + m.begin())
+                    for m in tokenizer_obj.tokenize(chunk)
+                ]
+            )
+            if line_ends is not None:
+                _record_line_ends(line_ends, chunk.split("\n"), chunk_byte_offset)
+            chunk_byte_offset += len(chunk)
+            continue
+
+        morphemes = tokenizer_obj.tokenize(chunk)
+        surfaces = [m.surface() for m in morphemes]
+        chunk_bytes = chunk.encode("utf-8")
+        if line_ends is not None:
+            _record_line_ends(line_ends, chunk_bytes.split(b"\n"), chunk_byte_offset)
+
+        if sum(map(len, surfaces)) == len(chunk):
+            # The tokens cover the window back to back (the usual case), so each byte
+            # offset is a running sum of the UTF-8 lengths before it, computed in C
+            # without further Morpheme calls.
+            results.extend(
+                zip(
+                    surfaces,
+                    itertools.accumulate(
+                        map(len, map(str.encode, surfaces)), initial=chunk_byte_offset
+                    ),
+                )
+            )
+            chunk_byte_offset += len(chunk_bytes)
+            continue
+
+        current_byte_offset = chunk_byte_offset
+        current_char_offset = 0
+
+        for m, surface in zip(morphemes, surfaces):
+            # Tokens come in order, so only the text skipped since the last token
+            # (e.g. spaces) needs to be encoded to advance the byte offset.
+            # Sudachi usually emits whitespace as tokens, so most gaps are empty.
+            begin = m.begin()
+            if begin != current_char_offset:
+                current_byte_offset += len(
+                    chunk[current_char_offset:begin].encode("utf-8")
+                )
+
+            append((surface, current_byte_offset))
+
+            current_byte_offset += len(surface.encode("utf-8"))
+            current_char_offset = m.end()
+
+        chunk_byte_offset += len(chunk_bytes)
+
+    return results
+
+
+_SURFACE = operator.itemgetter(0)
+_OFFSET = operator.itemgetter(1)
+
+
+def prepare_document(token_data: List[Tuple[str, int]]) -> Tuple[str, bytes]:
+    """
+    Build the FTS tokens string and packed token offsets from tokenize() output.
+    """
+    # Filter out whitespace-only tokens (newlines, spaces) which mess up token counting
+    token_data = [t for t in token_data if t[0].strip()]
+
+    # map() with itemgetter keeps the per-token extraction in C
+    tokens_str = " ".join(map(_SURFACE, token_data))
+    return tokens_str, pack_token_offsets(list(map(_OFFSET, token_data)))
+
+
+# Every TOKEN_SAMPLE_INTERVAL-th token gets a (stream position, preceding offset) entry
+# in the token_deltas header, so an arbitrary token needs at most this many varints
+# decoded.
+TOKEN_SAMPLE_INTERVAL = 64
+_TOKEN_SAMPLE = struct.Struct("<QQ")
+
+
+def pack_token_offsets(offsets: List[int]) -> bytes:
+    """
+    Encode ascending token byte offsets as LEB128 varints of successive deltas.
+
+    Layout: little-endian uint32 sample count, that many (stream position, offset of
+    the previous token) uint64 pairs, then the varint stream.
+    """
+    deltas = list(map(operator.sub, offsets, itertools.chain((0,), offsets)))
+    if not deltas or max(deltas) < 0x80:
+        # Every delta fits in one byte, so the stream is the deltas themselves
+        stream = bytes(deltas)
+        positions = range(0, len(deltas), TOKEN_SAMPLE_INTERVAL)
+    else:
+        out = bytearray()
+        positions = []
+        for i, delta in enumerate(deltas):
+            if not i % TOKEN_SAMPLE_INTERVAL:
+                positions.append(len(out))
+            while delta >= 0x80:
+                out.append((delta & 0x7F) | 0x80)
+                delta >>= 7
+            out.append(delta)
+        stream = bytes(out)
+    previous = itertools.chain(
+        (0,),
+        itertools.islice(
+            offsets, TOKEN_SAMPLE_INTERVAL - 1, None, TOKEN_SAMPLE_INTERVAL
+        ),
+    )
+    samples = list(itertools.chain.from_iterable(zip(positions, previous)))
+    return struct.pack(f"<I{len(samples)}Q", len(samples) // 2, *samples) + stream
+
+
+def token_offset_at(blob: bytes, index: int) -> int:
+    """
+    Return the byte offset of token `index` from a pack_token_offsets() blob.
+    """
+    (sample_count,) = struct.unpack_from("<I", blob)
+    sample = index // TOKEN_SAMPLE_INTERVAL
+    if sample >= sample_count:
+        raise IndexError(index)
+    header_size = 4 + _TOKEN_SAMPLE.size * sample_count
+    pos, offset = _TOKEN_SAMPLE.unpack_from(blob, 4 + _TOKEN_SAMPLE.size * sample)
+    pos += header_size
+    for _ in range(index - sample * TOKEN_SAMPLE_INTERVAL + 1):
+        shift = 0
+        while True:
+            byte = blob[pos]
+            pos += 1
+            offset += (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+    return offset
+
+
+def token_offsets_view(blob: bytes, stride: int = 8):
+    """
+    Return an indexable sequence of the offsets in a fixed-width blob: line_offsets
+    and legacy token_locations (little-endian uint64, or uint32 for 4-byte blobs).
+    """
+    typecode = "Q" if stride == 8 else "I"
+    if sys.byteorder == "little":
+        # Zero-copy: the blob is viewed in place instead of unpacked per token
+        return memoryview(blob).cast(typecode)
+    offsets = array.array(typecode, blob)
+    offsets.byteswap()
+    return offsets
+
+
+# Leading bytes inspected to detect binary files before reading the rest.
+BINARY_SNIFF_BYTES = 8192
+READ_CHUNK_BYTES = 128 * 1024
+
+
+def iter_text_file(file_path: str, digest=None) -> Iterator[str]:
+    """
+    Read a file in blocks and yield its UTF-8 text in pieces ending on a newline
+    (except possibly the last one). Raises UnicodeDecodeError for binary/non-utf8
+    files; files whose first bytes contain a NUL byte are rejected before the rest is read.
+    If digest (a hashlib object) is given, it is updated with every block read.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        head = os.read(fd, BINARY_SNIFF_BYTES)
+        nul_index = head.find(b"\x00")
+        if nul_index != -1:
+            raise UnicodeDecodeError(
+                "utf-8", head, nul_index, nul_index + 1, "NUL byte found, binary file"
+            )
+        if digest is not None:
+            digest.update(head)
+
+        carry = decoder.decode(head)
+        while True:
+            block = os.read(fd, READ_CHUNK_BYTES)
+            if not block:
+                break
+            if digest is not None:
+                digest.update(block)
+            text = carry + decoder.decode(block)
+            cut = text.rfind("\n") + 1
+            if cut:
+                yield text[:cut]
+                carry = text[cut:]
+            else:
+                carry = text
+        carry += decoder.decode(b"", final=True)
+    finally:
+        os.close(fd)
+    if carry:
+        yield carry
+
+
+def read_text_file(file_path: str) -> str:
+    """
+    Read a whole file and decode it as UTF-8.
+    Raises UnicodeDecodeError for binary/non-utf8 files.
+    """
+    return "".join(iter_text_file(file_path))
+
+
+def load_document(file_path: str) -> Tuple[str, bytes, bytes, bytes]:
+    """
+    Read and tokenize a file, returning (tokens_str, packed_offsets, packed_line_ends, digest).
+    The digest (see file_digest) is computed from the very bytes that were tokenized,
+    so it always describes the stored tokens even if the file changes meanwhile.
+    Raises UnicodeDecodeError for binary/non-utf8 files.
+    """
+    # deepcode ignore PathTraversal: This is a local file indexing tool that must access user-specified files.
+    line_ends = []
+    digest = _new_digest()
+    tokens_str, packed_offsets = prepare_document(
+        tokenize_file(file_path, line_ends, digest)
+    )
+    # Same layout as the token offsets; search resolves line numbers from it without reading the file
+    packed_line_ends = struct.pack(f"<{len(line_ends)}Q", *line_ends)
+    return tokens_str, packed_offsets, packed_line_ends, digest.digest()
+
+
+def _new_digest():
+    """The content hash used for documents_meta.content_hash (BLAKE2b-128)."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(file_path: str) -> bytes:
+    """
+    Return the BLAKE2b-128 digest of a file's bytes. Files with the same digest share
+    one tokenization, so duplicated content (vendored copies, generated files) is only
+    tokenized once.
+    """
+    digest = _new_digest()
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        while True:
+            block = os.read(fd, READ_CHUNK_BYTES)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        os.close(fd)
+    return digest.digest()
+
+
+def _load_for_index(candidate: Tuple[str, float, Optional[bytes]]):
+    """
+    Worker for index_directory: read and tokenize one (path, mtime, digest) candidate.
+    Returns (path, mtime, tokens_str, packed_offsets, packed_line_ends, digest), or None if the file is skipped.
+    The returned digest is that of the bytes actually tokenized, which differs from the
+    candidate's if the file was written after it was hashed.
+    """
+    file_path, file_mtime, _ = candidate
+    try:
+        tokens_str, packed_offsets, packed_line_ends, digest = load_document(file_path)
+    except UnicodeDecodeError:
+        return None
+    except Exception as e:
+        logger.warning("Failed to process %s: %s", file_path, e)
+        return None
+    return file_path, file_mtime, tokens_str, packed_offsets, packed_line_ends, digest
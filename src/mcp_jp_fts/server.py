@@ -1,63 +1,100 @@
+import atexit
+import bisect
 import contextlib
+import functools
 import html
+import json
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import re
 import sqlite3
-import struct
-import time
 import sys
-from typing import List, Tuple, Any
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
-from fastmcp import FastMCP
 import pathspec
-from sudachipy import dictionary, tokenizer
-from watchdog.observers import Observer
+from fastmcp import FastMCP
 from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from mcp_jp_fts.documents import (
+    _load_for_index,
+    file_digest,
+    load_document,
+    token_offset_at,
+    token_offsets_view,
+    tokenize,
+)
 
 # Initialize FastMCP server
 mcp = FastMCP("mcp-jp-fts")
 
-# SudachiPy Initialization
-# split_mode="A" for high recall (Shortest unit) as requested
-tokenizer_obj = dictionary.Dictionary().create()
-mode = tokenizer.Tokenizer.SplitMode.A
+# Logging goes to stderr (stdout carries the MCP protocol). Records are put on a
+# queue and written by a listener thread, so indexing never blocks on the write.
+logger = logging.getLogger("mcp_jp_fts")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(sys.stderr)
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+
+@functools.lru_cache(maxsize=4096)
+def tokenize_query(text: str) -> Tuple[Tuple[str, int], ...]:
+    """
+    Cached tokenize() for search queries, which are short and often repeated.
+    Document content is not routed through here since each document is unique.
+    """
+    return tuple(tokenize(text))
+
+
+# FTS5 syntax characters. The unicode61 tokenizer treats them as separators,
+# so mapping them to spaces keeps the phrase tokens the same while leaving
+# nothing inside a phrase that FTS5 could parse as syntax.
+_FTS_STRIP = str.maketrans(dict.fromkeys('"():*^-+', " "))
 
 
-def tokenize(text: str) -> List[Tuple[str, int]]:
+@functools.lru_cache(maxsize=4096)
+def build_fts_query(text: str) -> str:
     """
-    Tokenize text using SudachiPy and return list of (surface, byte_offset) tuples.
+    Build the FTS5 MATCH expression for a search query.
+    Each token surface becomes a quoted phrase so that words like OR/NEAR are
+    matched literally. Returns an empty string if nothing searchable is left.
     """
-    tokens = tokenizer_obj.tokenize(text, mode)
-    # SudachiPy returns character offsets (m.begin()).
-    # We need UTF-8 byte offsets for file seeking and FTS mapping.
-    # Recalculating byte offsets based on the utf-8 encoded text.
-    
-    results = []
-    current_byte_offset = 0
-    current_char_offset = 0
-    
-    for m in tokens:
-        surface = m.surface()
-        # Calculate bytes skipped since last token (e.g. spaces)
-        # However, SudachiPy usually returns contiguous tokens unless we skip something.
-        # But to be safe, we use substring from last char position to current token start.
-        # Wait, m.begin() is absolute char index.
-        
-        # Optimization: Maintain running char/byte count if tokens are sequential.
-        # But simpler: Get substring from 0 to m.begin(), encode, len().
-        # For non-sequential access it could be slow O(N^2), but tokens are sequential.
-        
-        # Efficient approach:
-        # We know tokens come in order.
-        skipped_text = text[current_char_offset:m.begin()]
-        current_byte_offset += len(skipped_text.encode("utf-8"))
-        
-        results.append((surface, current_byte_offset))
-        
-        surface_len_bytes = len(surface.encode("utf-8"))
-        current_byte_offset += surface_len_bytes
-        current_char_offset = m.end()
-        
-    return results
+    phrases = []
+    for surface, _ in tokenize_query(text):
+        surface = surface.translate(_FTS_STRIP).strip()
+        if surface:
+            phrases.append(f'"{surface}"')
+    return " ".join(phrases)
+
+
+# Worker processes reading and tokenizing files in index_directory. Tokenizing is
+# CPU-bound and mostly holds the GIL, so threads would not use more than one core.
+INDEX_WORKERS = os.cpu_count() or 1
+# Below this many files to (re)index, loading them in-process beats starting workers
+PROCESS_POOL_MIN_FILES = 64
+
+
+def _index_process_pool() -> ProcessPoolExecutor:
+    """
+    Pool for index_directory. Workers are spawned rather than forked: the server
+    runs other threads (watcher, logging), and each worker creates its own
+    SudachiPy tokenizer on first use. Workers only import mcp_jp_fts.documents (and the
+    console script's lightweight package entry point), not this module.
+    """
+    return ProcessPoolExecutor(
+        max_workers=INDEX_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
 
 
 def validate_path(path: str) -> str:
@@ -77,45 +114,179 @@ def validate_path(path: str) -> str:
 DB_PATH = "documents.db"
 
 
+# A single connection is shared by all tool calls and the watcher thread.
+# Reusing it keeps SQLite's page cache and statement cache warm between calls.
+_db_lock = threading.RLock()
+_db_conn = None
+_db_conn_path = None
+
+
 @contextlib.contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH, timeout=30.0)
-    init_db(conn)
+    """
+    Yield the shared connection, holding the lock for the duration of the block.
+    The connection is (re)opened when DB_PATH changes.
+    """
+    global _db_conn, _db_conn_path
+    with _db_lock:
+        if _db_conn is None or _db_conn_path != DB_PATH:
+            close_db()
+            # Autocommit mode: writes are grouped explicitly with _transaction(), so the
+            # sqlite3 module never opens (or commits) a transaction behind our back
+            conn = sqlite3.connect(
+                DB_PATH, timeout=30.0, check_same_thread=False, isolation_level=None
+            )
+            # Connection-level tuning for bulk writes (per-connection settings)
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute("PRAGMA temp_store=MEMORY;")
+            conn.execute("PRAGMA cache_size=-262144;")
+            # Read FTS5 segments through the OS page cache instead of copying them
+            conn.execute("PRAGMA mmap_size=268435456;")
+            # Checkpoint the WAL every 1000 pages (the default, pinned here) during bulk writes
+            conn.execute("PRAGMA wal_autocheckpoint=1000;")
+            try:
+                init_db(conn)
+            except Exception:
+                conn.close()
+                raise
+            _db_conn, _db_conn_path = conn, DB_PATH
+        yield _db_conn
+
+
+def close_db():
+    """Close the shared connection, letting SQLite refresh its planner statistics first."""
+    global _db_conn, _db_conn_path
+    with _db_lock:
+        if _db_conn is None:
+            return
+        try:
+            # Recommended once before closing a long-lived connection
+            _db_conn.execute("PRAGMA optimize;")
+        except sqlite3.Error:
+            pass
+        _db_conn.close()
+        _db_conn, _db_conn_path = None, None
+        _search_cache.clear()
+
+
+atexit.register(close_db)
+
+
+# Bumped on every committed write through _transaction(). Together with PRAGMA data_version
+# (which changes when another connection commits), it identifies the index state that a
+# cached search result was computed from.
+_index_version = 0
+# (index state, query, filters, limit) -> results; oldest entries are evicted first
+_search_cache = {}
+SEARCH_CACHE_SIZE = 256
+
+
+@contextlib.contextmanager
+def _transaction(conn: sqlite3.Connection):
+    """
+    Run the block in one write transaction, committed on success and rolled back on error.
+    IMMEDIATE takes the write lock up front, so a concurrent writer waits on the busy
+    timeout instead of failing when a read transaction upgrades.
+    """
+    conn.execute("BEGIN IMMEDIATE")
     try:
         yield conn
-    finally:
-        conn.close()
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    global _index_version
+    _index_version += 1
+
+
+FTS_TABLE_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+        path UNINDEXED,
+        tokens,
+        tokenize='unicode61 remove_diacritics 2'
+    );
+"""
 
 
 def init_db(conn: sqlite3.Connection):
     """Initialize the SQLite database with a FTS5 virtual table."""
-    with conn:
-        conn.execute("""
-            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
-                path,
-                content,
-                tokens,
-                tokenize='unicode61' 
-            );
-        """)
+    # Larger pages mean fewer reads per FTS5 segment. The page size is fixed once
+    # the first table is written (and WAL is enabled), so only set it on a new DB.
+    if conn.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0:
+        conn.execute("PRAGMA page_size=8192;")
+
+    # Enable Write-Ahead Logging (WAL) for better concurrency. The journal mode cannot
+    # change inside a transaction, so this runs before the migrations below.
+    conn.execute("PRAGMA journal_mode=WAL;")
+
+    with _transaction(conn):
+        # Migration: Earlier schemas also stored (and indexed) the raw file content in
+        # documents_fts. Snippets are read from disk, so only the Sudachi tokens are kept now.
+        # FTS5 tables cannot be altered, so drop the old table and force a re-index.
+        fts_columns = [r[1] for r in conn.execute("PRAGMA table_info(documents_fts)")]
+        if "content" in fts_columns:
+            logger.info(
+                "Migration: Dropping raw content column from index. Clearing index to force rebuild."
+            )
+            conn.execute("DROP TABLE documents_fts")
+            if conn.execute(
+                "SELECT name FROM sqlite_master WHERE name = 'documents_meta'"
+            ).fetchone():
+                conn.execute("DELETE FROM documents_meta")
+
+        # Migration: documents_fts rows are keyed by documents_meta.id (rowid), so deletes can
+        # use the meta table's index instead of scanning the FTS table by path.
+        # Older meta tables have no explicit id; rebuild both tables to force a re-index.
+        meta_columns = [r[1] for r in conn.execute("PRAGMA table_info(documents_meta)")]
+        if meta_columns and "id" not in meta_columns:
+            logger.info(
+                "Migration: Keying index rows by metadata id. Clearing index to force rebuild."
+            )
+            conn.execute("DROP TABLE documents_meta")
+            conn.execute("DROP TABLE IF EXISTS documents_fts")
+
+        conn.execute(FTS_TABLE_SQL)
         
         # Meta table for incremental indexing
         conn.execute("""
             CREATE TABLE IF NOT EXISTS documents_meta (
-                path TEXT PRIMARY KEY,
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
                 mtime REAL,
                 scanned_at REAL,
-                token_locations BLOB
+                token_locations BLOB,
+                line_offsets BLOB,
+                token_deltas BLOB,
+                content_hash BLOB
             );
         """)
         
-        # Migration: Add token_locations column if it doesn't exist (for existing DBs)
-        try:
-            conn.execute("ALTER TABLE documents_meta ADD COLUMN token_locations BLOB")
-        except sqlite3.OperationalError:
-            # Column likely already exists
-            pass
-            
+        # Migration: Add the BLOB columns added after the first release if they don't exist (for existing DBs)
+        for column in (
+            "token_locations",
+            "line_offsets",
+            "token_deltas",
+            "content_hash",
+        ):
+            try:
+                conn.execute(f"ALTER TABLE documents_meta ADD COLUMN {column} BLOB")
+            except sqlite3.OperationalError:
+                # Column likely already exists
+                pass
+        # Looked up for every (re)indexed file to reuse the tokens of identical content
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS documents_meta_content_hash ON documents_meta(content_hash)"
+        )
+
+        # When each root was last indexed. Unchanged files are not rewritten by a
+        # re-index, so their scanned_at cannot tell when the last pass ran.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS index_runs (
+                root TEXT PRIMARY KEY,
+                finished_at REAL
+            );
+        """)
+
         # Migration: If documents_fts has data but documents_meta is empty (e.g. upgraded from v1),
         # we must clear documents_fts to force re-indexing.
         # Otherwise, search_documents will fail to look up token maps.
@@ -123,12 +294,12 @@ def init_db(conn: sqlite3.Connection):
         meta_count = conn.execute("SELECT count(*) FROM documents_meta").fetchone()[0]
         
         if fts_count > 0 and meta_count == 0:
-            print("Migration: Detected legacy index without metadata. Clearing index to force rebuild.", file=sys.stderr)
+            logger.info(
+                "Migration: Detected legacy index without metadata. Clearing index to force rebuild."
+            )
             conn.execute("DELETE FROM documents_fts")
             
-        # Enable Write-Ahead Logging (WAL) for better concurrency
-        conn.execute("PRAGMA journal_mode=WAL;")
-        # Note: 'unicode61' is the default tokenizer which works well with space-separated tokens
+        # Note: 'unicode61' splits on the spaces between the Sudachi tokens
 
 
 
@@ -137,103 +308,372 @@ def init_db(conn: sqlite3.Connection):
 observer = Observer()
 # Store path -> FTSHandler to allow re-scheduling on observer restart
 WATCHED_PATHS = {}
+# path -> ObservedWatch on the current observer, so a single watch can be unscheduled
+_watches = {}
+# Serializes watch_directory / unwatch_directory, which both touch the observer
+_watch_lock = threading.Lock()
 
 def _update_or_remove_file(file_path: str) -> str:
     """Internal helper to update or remove a file from index."""
     file_path = validate_path(file_path)
     current_time = time.time()
     
-    with get_db() as conn:
-        with conn:
-            if not os.path.exists(file_path):
-                # File deleted
-                conn.execute("DELETE FROM documents_fts WHERE path = ?", (file_path,))
-                conn.execute("DELETE FROM documents_meta WHERE path = ?", (file_path,))
-                return f"Removed {file_path} from index."
-            
-            try:
-                # 1. Read and Tokenize
-                # deepcode ignore PathTraversal: This is a local file indexing tool that must access user-specified files.
-                with open(file_path, "r", encoding="utf-8", newline="") as f:
-                    content = f.read()
-                
-                # Tokenize and get offsets
-                raw_token_data = tokenize(content)
-                # Filter out whitespace-only tokens (consistent with index_directory)
-                token_data = [t for t in raw_token_data if t[0].strip()]
-                
-                token_surfaces = [t[0] for t in token_data]
-                token_offsets = [t[1] for t in token_data]
-                
-                # Join tokens for FTS
-                tokens_str = " ".join(token_surfaces)
-                
-                # Pack offsets only (unsigned long long, 8 bytes) to support files > 4GB
-                # We use '<' for little-endian explicitly.
-                packed_offsets = struct.pack(f"<{len(token_offsets)}Q", *token_offsets)
-                
-                # 2. Update FTS
-                conn.execute("DELETE FROM documents_fts WHERE path = ?", (file_path,))
-                conn.execute(
-                    "INSERT INTO documents_fts (path, content, tokens) VALUES (?, ?, ?)",
-                    (file_path, content, tokens_str),
-                )
-                
-                # 3. Update Metadata
-                file_mtime = os.path.getmtime(file_path)
-                conn.execute(
-                    """
-                    INSERT INTO documents_meta (path, mtime, scanned_at, token_locations) 
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(path) DO UPDATE SET
-                        mtime = excluded.mtime,
-                        scanned_at = excluded.scanned_at,
-                        token_locations = excluded.token_locations
-                    """,
-                    (file_path, file_mtime, current_time, packed_offsets)
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        st = None
+
+    try:
+        if st is None:
+            # File deleted
+            with get_db() as conn:
+                with _transaction(conn):
+                    _remove_documents(conn, [file_path])
+            return f"Removed {file_path} from index."
+
+        if st.st_size > MAX_FILE_BYTES:
+            with get_db() as conn:
+                with _transaction(conn):
+                    _remove_documents(conn, [file_path])
+            return f"Skipped large file: {file_path}"
+
+        # Watchers often report modifications that did not change the file
+        # (e.g. editor saves); skip those before reading or tokenizing anything.
+        # Any other mtime is a change: content restored with an older mtime
+        # (cp -p, tar x, git checkout, backups) must be re-indexed too.
+        file_mtime = st.st_mtime
+        with get_db() as conn:
+            row = conn.execute(
+                "SELECT mtime FROM documents_meta WHERE path = ?", (file_path,)
+            ).fetchone()
+        if row and row[0] is not None and file_mtime == row[0]:
+            return f"Skipped (unchanged) {file_path}"
+
+        # 1. Read and Tokenize (outside the DB lock), unless identical content is indexed.
+        # The stored digest always comes with its tokens: either both are copied, or
+        # load_document hashes the bytes it tokenizes.
+        digest = file_digest(file_path)
+        with get_db() as conn:
+            document = _find_tokenized(conn, [digest]).get(digest)
+        if document is None:
+            tokens_str, packed_offsets, packed_line_ends, digest = load_document(
+                file_path
+            )
+        else:
+            tokens_str, packed_offsets, packed_line_ends = document
+
+        # 2. Update FTS and Metadata
+        with get_db() as conn:
+            with _transaction(conn):
+                _write_documents(
+                    conn,
+                    [
+                        (
+                            file_path,
+                            file_mtime,
+                            tokens_str,
+                            packed_offsets,
+                            packed_line_ends,
+                            digest,
+                        )
+                    ],
+                    current_time,
                 )
-                return f"Updated {file_path} in index."
+        return f"Updated {file_path} in index."
 
-            except UnicodeDecodeError:
-                return f"Skipped binary/non-utf8 file: {file_path}"
-            except Exception as e:
-                return f"Failed to update {file_path}: {e}"
+    except UnicodeDecodeError:
+        return f"Skipped binary/non-utf8 file: {file_path}"
+    except Exception as e:
+        return f"Failed to update {file_path}: {e}"
+
+
+# Editors save through swap/backup files next to the real one; events for these never
+# reach SQLite.
+WATCH_TEMP_SUFFIXES = ("~", ".swp", ".swx", ".tmp", ".part", ".crdownload")
+# Events for the same path within this window are coalesced into one re-index.
+WATCH_DEBOUNCE_SECONDS = 0.5
 
 
 class FTSHandler(FileSystemEventHandler):
     def __init__(self, root_path, ignore_spec=None):
         self.root_path = validate_path(root_path)
         self.ignore_spec = ignore_spec
+        self._match_ignored = ignore_matcher(ignore_spec) if ignore_spec else None
+        # Event paths are built from the watched root, so the relative path for
+        # .gitignore matching is a plain slice, as in index_directory
+        self._root_prefix = os.path.join(self.root_path, "")
+        # path -> monotonic time of its latest event; drained by a background thread
+        # that only runs while something is pending.
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._drainer = None
 
     def _should_ignore(self, path):
+        name = os.path.basename(path)
+        if name.endswith(WATCH_TEMP_SUFFIXES) or not has_text_extension(name):
+            return True
         if self.ignore_spec:
-            rel_path = os.path.relpath(path, self.root_path)
-            return self.ignore_spec.match_file(rel_path)
+            if path.startswith(self._root_prefix):
+                rel_path = path[len(self._root_prefix) :]
+            else:
+                rel_path = os.path.relpath(path, self.root_path)
+            return self._match_ignored(rel_path)
         return False
 
+    def _schedule(self, path):
+        if self._should_ignore(path):
+            return
+        with self._pending_lock:
+            self._pending[path] = time.monotonic()
+            if self._drainer is None:
+                self._drainer = threading.Thread(
+                    target=self._drain, name="mcp-jp-fts-watch", daemon=True
+                )
+                self._drainer.start()
+
+    def _drain(self):
+        try:
+            while True:
+                time.sleep(WATCH_DEBOUNCE_SECONDS)
+                with self._pending_lock:
+                    cutoff = time.monotonic() - WATCH_DEBOUNCE_SECONDS
+                    due = [p for p, t in self._pending.items() if t <= cutoff]
+                    for p in due:
+                        del self._pending[p]
+                    if not self._pending and not due:
+                        self._drainer = None
+                        return
+                for p in due:
+                    # Re-stats the path, so a file deleted or moved away is removed.
+                    # One failing path (e.g. a locked database) must not stop the rest.
+                    try:
+                        _update_or_remove_file(p)
+                    except Exception:
+                        logger.exception("Failed to update %s from watch event", p)
+        finally:
+            # If the thread dies anyway, the next event starts a new drainer
+            with self._pending_lock:
+                if self._drainer is threading.current_thread():
+                    self._drainer = None
+
     def on_moved(self, event):
         if not event.is_directory:
-            if not self._should_ignore(event.src_path):
-                _update_or_remove_file(event.src_path) # Will delete because it's gone
-            if not self._should_ignore(event.dest_path):
-                _update_or_remove_file(event.dest_path) # Will add
+            self._schedule(event.src_path)
+            self._schedule(event.dest_path)
 
     def on_created(self, event):
         if not event.is_directory:
-            if not self._should_ignore(event.src_path):
-                _update_or_remove_file(event.src_path)
+            self._schedule(event.src_path)
 
     def on_deleted(self, event):
         if not event.is_directory:
-            if not self._should_ignore(event.src_path):
-                _update_or_remove_file(event.src_path)
+            self._schedule(event.src_path)
 
     def on_modified(self, event):
         if not event.is_directory:
-            if not self._should_ignore(event.src_path):
-                _update_or_remove_file(event.src_path)
+            self._schedule(event.src_path)
+
+
+# Only files with these extensions (or without any extension, e.g. README, Makefile)
+# are opened during indexing; everything else is skipped from the directory entry alone.
+TEXT_EXTENSIONS = frozenset(
+    {
+        ".txt",
+        ".md",
+        ".markdown",
+        ".rst",
+        ".adoc",
+        ".org",
+        ".tex",
+        ".csv",
+        ".tsv",
+        ".log",
+        ".json",
+        ".yaml",
+        ".yml",
+        ".toml",
+        ".ini",
+        ".cfg",
+        ".conf",
+        ".xml",
+        ".html",
+        ".htm",
+        ".css",
+        ".py",
+        ".js",
+        ".jsx",
+        ".ts",
+        ".tsx",
+        ".go",
+        ".rs",
+        ".java",
+        ".kt",
+        ".c",
+        ".h",
+        ".cpp",
+        ".hpp",
+        ".cc",
+        ".cs",
+        ".rb",
+        ".php",
+        ".swift",
+        ".sh",
+        ".sql",
+        ".vue",
+    }
+)
+# Files larger than this are not indexed
+MAX_FILE_BYTES = 4_000_000
+# SQLite files written next to the index database
+DB_FILE_SUFFIXES = ("", "-wal", "-shm", "-journal")
+
+
+def has_text_extension(name: str) -> bool:
+    """Check the file name against the TEXT_EXTENSIONS allowlist."""
+    # Same result as os.path.splitext (leading dots do not start an extension),
+    # without its per-call overhead; this runs for every file in a walk.
+    i = name.rfind(".")
+    if i == -1 or (name[0] == "." and not name[:i].strip(".")):
+        return True
+    return name[i:].lower() in TEXT_EXTENSIONS
+
+
+def ignore_matcher(spec: pathspec.PathSpec) -> Callable[[str], bool]:
+    """
+    Return a predicate equivalent to spec.match_file for relative paths.
+    Without negated ("!") patterns the result does not depend on pattern order, so all
+    patterns are combined into one regular expression and each path is matched once
+    instead of once per pattern.
+    """
+    patterns = [p for p in spec.patterns if p.include is not None]
+    if os.sep != "/" or not all(
+        p.include and isinstance(p, pathspec.RegexPattern) for p in patterns
+    ):
+        return spec.match_file
+    if not patterns:
+        return lambda path: False
+    combined = re.compile("|".join(f"(?:{p.regex.pattern})" for p in patterns))
+    match = combined.match
+    return lambda path: match(path) is not None
+
+
+def iter_files(
+    root: str, skip_dir: Optional[Callable[[str], bool]] = None
+) -> Iterator[os.DirEntry]:
+    """
+    Recursively yield DirEntry objects of regular files under root, skipping hidden entries.
+    Uses os.scandir so file types come from the cached directory entries instead of extra stat calls.
+    Directories for which skip_dir(path) is true are not descended into.
+    """
+    # An explicit stack instead of recursion: each file is yielded straight to the
+    # caller rather than through one nested generator per directory level, and
+    # deep trees cannot hit the recursion limit.
+    stack = [root]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        directory = pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name[0] == ".":
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if skip_dir is None or not skip_dir(entry.path):
+                            push(entry.path)
+                    elif entry.is_file():
+                        yield entry
+        except OSError as e:
+            logger.warning("Failed to scan %s: %s", directory, e)
 
 
+def _find_tokenized(conn: sqlite3.Connection, digests: Iterable[bytes]) -> dict:
+    """
+    Map each content digest already indexed (under any path) to its
+    (tokens_str, packed_offsets, packed_line_ends).
+    """
+    digests = list(digests)
+    if not digests:
+        return {}
+    placeholders = ",".join("?" * len(digests))
+    cursor = conn.execute(
+        f"""
+        SELECT m.content_hash, f.tokens, m.token_deltas, m.line_offsets
+        FROM documents_meta m JOIN documents_fts f ON f.rowid = m.id
+        WHERE m.content_hash IN ({placeholders}) AND m.token_deltas IS NOT NULL
+        """,
+        digests,
+    )
+    return {row[0]: row[1:] for row in cursor}
+
+
+def _write_documents(
+    conn: sqlite3.Connection,
+    documents: List[Tuple[str, float, str, bytes, bytes, Optional[bytes]]],
+    scanned_at: float,
+):
+    """
+    Write a batch of (path, mtime, tokens_str, packed_offsets, packed_line_ends, digest) documents
+    (caller manages the transaction).
+    """
+    meta_rows = [(d[0], d[1], scanned_at, d[3], d[4], d[5]) for d in documents]
+    fts_rows = [(d[2], d[0]) for d in documents]
+
+    # Update Metadata first; the upsert keeps the id of existing paths stable
+    conn.executemany(
+        """
+        INSERT INTO documents_meta (path, mtime, scanned_at, token_deltas, line_offsets, content_hash) 
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            mtime = excluded.mtime,
+            scanned_at = excluded.scanned_at,
+            token_deltas = excluded.token_deltas,
+            token_locations = NULL,
+            line_offsets = excluded.line_offsets,
+            content_hash = excluded.content_hash
+        """,
+        meta_rows,
+    )
+    # Update FTS under the meta id; REPLACE drops an existing row with that rowid,
+    # so re-indexed files need no separate DELETE pass
+    conn.executemany(
+        "INSERT OR REPLACE INTO documents_fts (rowid, path, tokens) SELECT id, path, ? FROM documents_meta WHERE path = ?",
+        fts_rows,
+    )
+
+
+def _remove_documents(conn: sqlite3.Connection, paths: List[str]):
+    """Remove the given paths from the FTS index and metadata (caller manages the transaction)."""
+    # The paths are bound once as a JSON array, so each table is cleaned by a
+    # single set-based statement instead of one statement per path.
+    paths_json = json.dumps(paths)
+    conn.execute(
+        "DELETE FROM documents_fts WHERE rowid IN "
+        "(SELECT id FROM documents_meta WHERE path IN (SELECT value FROM json_each(?)))",
+        (paths_json,),
+    )
+    conn.execute(
+        "DELETE FROM documents_meta WHERE path IN (SELECT value FROM json_each(?))",
+        (paths_json,),
+    )
+
+
+# Matches root itself or any path below it. A range comparison instead of
+# LIKE 'root/%' can use the documents_meta path index (LIKE is case-insensitive,
+# so it cannot) and does not treat "_" or "%" in directory names as wildcards.
+PATH_UNDER_SQL = "(path = ? OR (path >= ? AND path < ?))"
+
+
+def path_under_params(root: str) -> Tuple[str, str, str]:
+    """Parameters for PATH_UNDER_SQL: root, root + sep, and the first string past that prefix."""
+    prefix = os.path.join(root, "")
+    return root, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+# index_directory fully optimizes the FTS index when at least 1/OPTIMIZE_CHANGED_RATIO
+# of the indexed files changed in one pass
+OPTIMIZE_CHANGED_RATIO = 2
+
 
 @mcp.tool()
 def index_directory(root_path: str) -> str:
@@ -248,141 +688,204 @@ def index_directory(root_path: str) -> str:
     updated_count = 0
     skipped_count = 0
     
-    with get_db() as conn:
-        # We manually manage transactions (commits) inside the loop for concurrency
-        # with conn:  <-- Removed monolithic transaction block
-            # Load .gitignore if exists
-            gitignore_path = os.path.join(root_path, ".gitignore")
-            ignore_spec = None
-            if os.path.exists(gitignore_path):
-                try:
-                    with open(gitignore_path, "r", encoding="utf-8") as f:
-                        ignore_spec = pathspec.PathSpec.from_lines("gitignore", f)
-                except Exception as e:
-                    print(f"Failed to load .gitignore: {e}", file=sys.stderr)
+    # Load .gitignore if exists
+    gitignore_path = os.path.join(root_path, ".gitignore")
+    ignore_spec = None
+    if os.path.exists(gitignore_path):
+        try:
+            with open(gitignore_path, "r", encoding="utf-8") as f:
+                ignore_spec = pathspec.PathSpec.from_lines("gitignore", f)
+        except Exception as e:
+            logger.warning("Failed to load .gitignore: %s", e)
+
+    # deepcode ignore PathTraversal: This is a local file indexing tool that must walk user-specified trees.
+    # Batch configuration: files needing an update are collected, then read and
+    # tokenized in parallel by the worker processes. Only this thread writes to
+    # SQLite, one transaction per batch. Unchanged files are not written at all;
+    # they are only remembered as seen, so they are not treated as stale.
+    # The shared connection (and its lock) is only held for the SQL steps, never
+    # while walking, hashing or tokenizing, so watcher updates and other tool calls
+    # run between the batches.
+    BATCH_SIZE = 500
+    pending_files = []
+    seen_paths = set()
+    executor = None
+
+    def flush_pending():
+        nonlocal executor
+        # Hashing is far cheaper than tokenizing: content already indexed under
+        # another path is copied, and duplicates within the batch are loaded once.
+        candidates = []
+        for file_path, file_mtime in pending_files:
+            try:
+                digest = file_digest(file_path)
+            except OSError:
+                digest = None  # _load_for_index reports the failure
+            candidates.append((file_path, file_mtime, digest))
+        with get_db() as conn:
+            known = _find_tokenized(
+                conn, {c[2] for c in candidates if c[2] is not None}
+            )
 
-            # deepcode ignore PathTraversal: This is a local file indexing tool that must walk user-specified trees.
-            current_files = set()
-            
-            # Batch commit configuration
-            BATCH_SIZE = 50
-            pending_updates = 0
+        documents = []
+        to_load = []
+        duplicates = []
+        loading = set()
+        for candidate in candidates:
+            file_path, file_mtime, digest = candidate
+            if digest in known:
+                documents.append((file_path, file_mtime, *known[digest], digest))
+            elif digest in loading:
+                duplicates.append(candidate)
+            else:
+                if digest is not None:
+                    loading.add(digest)
+                to_load.append(candidate)
+
+        # Start the pool lazily: a re-index with few changes never pays for it
+        if (
+            executor is None
+            and INDEX_WORKERS > 1
+            and len(to_load) >= PROCESS_POOL_MIN_FILES
+        ):
+            executor = stack.enter_context(_index_process_pool())
+        if executor is not None:
+            loaded = executor.map(_load_for_index, to_load, chunksize=16)
+        else:
+            loaded = map(_load_for_index, to_load)
+        loaded = [d for d in loaded if d is not None]
+        documents.extend(loaded)
+        if duplicates:
+            by_digest = {d[5]: d[2:5] for d in loaded}
+            # A duplicate whose twin changed between hashing and loading (so it was
+            # loaded under another digest) is loaded itself
+            changed = []
+            for file_path, file_mtime, digest in duplicates:
+                if digest in by_digest:
+                    documents.append(
+                        (file_path, file_mtime, *by_digest[digest], digest)
+                    )
+                else:
+                    changed.append((file_path, file_mtime, digest))
+            documents.extend(d for d in map(_load_for_index, changed) if d is not None)
+        if documents:
+            with get_db() as conn, _transaction(conn):
+                _write_documents(conn, documents, current_time)
+            seen_paths.update(d[0] for d in documents)
+        pending_files.clear()
+        return len(documents)
+
+    with contextlib.ExitStack() as stack:
+        # Never index the index database itself
+        db_files = {os.path.abspath(DB_PATH) + suffix for suffix in DB_FILE_SUFFIXES}
+
+        # DirEntry.path is already an absolute path under root_path, so the
+        # relative path for .gitignore matching is a plain slice.
+        rel_start = len(os.path.join(root_path, ""))
+
+        # Load the stored mtimes under root_path in one scan instead of one
+        # query per file
+        under_root = path_under_params(root_path)
+        with get_db() as conn:
+            known_mtimes = dict(
+                conn.execute(
+                    f"SELECT path, mtime FROM documents_meta WHERE {PATH_UNDER_SQL}",
+                    under_root,
+                )
+            )
 
-            for dirpath, _, filenames in os.walk(root_path):
-                for filename in filenames:
-                    if filename.startswith("."):
-                        continue
-                    
-                    file_path = os.path.join(dirpath, filename)
-                    
-                    if ignore_spec:
-                        rel_path = os.path.relpath(file_path, root_path)
-                        if ignore_spec.match_file(rel_path):
-                            continue
-                            
-                    # Add to current_files set
-                    abs_path = validate_path(file_path)
-                    current_files.add(abs_path)
+        # Bind hot-loop lookups to locals
+        is_text = has_text_extension
+        match_ignored = ignore_matcher(ignore_spec) if ignore_spec else None
+        known_mtime = known_mtimes.get
+        queue_file = pending_files.append
+        mark_unchanged = seen_paths.add
+
+        # Prune ignored directories (node_modules/, build/, ...) from the walk.
+        # Like git, files below an excluded directory cannot be re-included.
+        skip_dir = (
+            (lambda path: match_ignored(path[rel_start:] + "/"))
+            if match_ignored
+            else None
+        )
 
-                    try:
-                        # Get file mtime
-                        file_mtime = os.path.getmtime(file_path)
-                        
-                        # Check if update needed
-                        row = conn.execute(
-                            "SELECT mtime FROM documents_meta WHERE path = ?", 
-                            (file_path,)
-                        ).fetchone()
-                        
-                        needs_update = True
-                        if row:
-                            db_mtime = row[0]
-                            if file_mtime <= db_mtime:
-                                needs_update = False
-                        
-                        if needs_update:
-                            # 1. Read and Tokenize
-                            # deepcode ignore PathTraversal: Validated path access
-                            with open(file_path, "r", encoding="utf-8", newline="") as f:
-                                content = f.read()
-                            
-                            # Tokenize and get offsets
-                            raw_token_data = tokenize(content)
-                            # Filter out whitespace-only tokens (newlines, spaces) which mess up token counting
-                            token_data = [t for t in raw_token_data if t[0].strip()]
-                            
-                            token_surfaces = [t[0] for t in token_data]
-                            token_offsets = [t[1] for t in token_data]
-                            
-                            tokens_str = " ".join(token_surfaces)
-                            packed_offsets = struct.pack(f"<{len(token_offsets)}Q", *token_offsets)
-                            
-                            # 2. Update FTS (Delete old entry if exists, then Insert)
-                            with conn:
-                                conn.execute("DELETE FROM documents_fts WHERE path = ?", (file_path,))
-                                conn.execute(
-                                    "INSERT INTO documents_fts (path, content, tokens) VALUES (?, ?, ?)",
-                                    (file_path, content, tokens_str),
-                                )
-                                # 3. Update Metadata (mtime and scanned_at)
-                                conn.execute(
-                                    """
-                                    INSERT INTO documents_meta (path, mtime, scanned_at, token_locations) 
-                                    VALUES (?, ?, ?, ?)
-                                    ON CONFLICT(path) DO UPDATE SET
-                                        mtime = excluded.mtime,
-                                        scanned_at = excluded.scanned_at,
-                                        token_locations = excluded.token_locations
-                                    """,
-                                    (file_path, file_mtime, current_time, packed_offsets)
-                                )
-                            updated_count += 1
-
-                        else:
-                            skipped_count += 1
-                            # Update scanned_at even if skipped, so it's not marked as stale
-                            with conn:
-                                conn.execute(
-                                    "UPDATE documents_meta SET scanned_at = ? WHERE path = ?",
-                                    (current_time, file_path)
-                                )
-                        
-                        # Use explicit transaction commit for batches to avoid locking the DB for too long
-                        if updated_count > 0 and updated_count % BATCH_SIZE == 0:
-                            conn.commit()
-
-                    except UnicodeDecodeError:
-                        continue
-                    except Exception as e:
-                        print(f"Failed to process {file_path}: {e}", file=sys.stderr)
-            
-            # Commit any remaining updates
-            conn.commit()
+        for entry in iter_files(root_path, skip_dir):
+            file_path = entry.path
+            if not is_text(entry.name) or file_path in db_files:
+                continue
 
-            # 4. Cleanup Stale Entries
-            # Delete files under root_path that were NOT scanned in this pass
-            # (scanned_at < current_time)
-            
-            # Prepare LIKE pattern for root_path
-            search_pattern = root_path if root_path.endswith(os.sep) else root_path + os.sep
-            search_pattern = search_pattern + "%"
-            
-            # Cleanup stale entries atomically and efficiently
-            with conn:
-                conn.execute(
-                    """
-                    DELETE FROM documents_fts
-                    WHERE path IN (SELECT path FROM documents_meta WHERE (path = ? OR path LIKE ?) AND scanned_at < ?)
-                    """,
-                    (root_path, search_pattern, current_time)
-                )
-                cursor_meta = conn.execute(
-                    "DELETE FROM documents_meta WHERE (path = ? OR path LIKE ?) AND scanned_at < ?",
-                    (root_path, search_pattern, current_time)
-                )
-                conn.commit()
-            
-            deleted_count = cursor_meta.rowcount
+            if match_ignored and match_ignored(file_path[rel_start:]):
+                continue
+
+            try:
+                # Get file size and mtime from the directory entry
+                st = entry.stat()
+                if st.st_size > MAX_FILE_BYTES:
+                    continue
+                file_mtime = st.st_mtime
+
+                # Check if update needed: any mtime change, including an older one
+                db_mtime = known_mtime(file_path)
+                if db_mtime is None or file_mtime != db_mtime:
+                    queue_file((file_path, file_mtime))
+                else:
+                    skipped_count += 1
+                    # Seen in this pass, so it is not removed as stale
+                    mark_unchanged(file_path)
+
+                # Flush full batches to avoid locking the DB for too long
+                if len(pending_files) >= BATCH_SIZE:
+                    updated_count += flush_pending()
+
+            except Exception as e:
+                logger.warning("Failed to process %s: %s", file_path, e)
+
+        # Flush any remaining updates
+        if pending_files:
+            updated_count += flush_pending()
+
+    # 4. Cleanup Stale Entries
+    # Delete files under root_path that were indexed before this pass but were
+    # neither unchanged nor (re)indexed in it. Both sets are already in memory,
+    # so finding them needs no query; the FTS rows are deleted by the meta id.
+    stale_paths = [p for p in known_mtimes if p not in seen_paths]
+    deleted_count = len(stale_paths)
+    changed_count = updated_count + deleted_count
+
+    with get_db() as conn:
+        if stale_paths:
+            with _transaction(conn):
+                _remove_documents(conn, stale_paths)
+
+        # Coalesce the b-tree segments written by the batches above in one go.
+        # When most of the index was rewritten (e.g. a first-time index), merge
+        # everything into a single segment; otherwise an incremental merge is
+        # enough and avoids rewriting the whole index for a few changed files.
+        if changed_count > 0:
+            total_count = conn.execute(
+                "SELECT count(*) FROM documents_meta"
+            ).fetchone()[0]
+            with _transaction(conn):
+                if changed_count * OPTIMIZE_CHANGED_RATIO >= total_count:
+                    conn.execute(
+                        "INSERT INTO documents_fts(documents_fts) VALUES('optimize')"
+                    )
+                else:
+                    conn.execute(
+                        "INSERT INTO documents_fts(documents_fts, rank) VALUES('merge', 1000)"
+                    )
+
+        # Refresh planner statistics after the index changed
+        if changed_count > 0:
+            conn.execute("ANALYZE documents_meta")
+            conn.execute("PRAGMA optimize")
+
+        # One row per root, even when nothing changed. A single autocommit
+        # statement, so cached search results (keyed on document writes) stay valid.
+        conn.execute(
+            "INSERT OR REPLACE INTO index_runs (root, finished_at) VALUES (?, ?)",
+            (root_path, current_time),
+        )
 
     return f"Indexed {updated_count} files, Skipped {skipped_count} unchanged, Deleted {deleted_count} stale in {root_path}."
 
@@ -396,28 +899,67 @@ def delete_index(root_path: str) -> str:
 
     context_manager = get_db()
     with context_manager as conn:
-        with conn:
-            # Using LIKE 'root_path%' to match all subpaths
-            # Ensure directory separator is included to avoid partial matches on directory names
-            # e.g. /tmp/test matching /tmp/testing
-            search_pattern = root_path if root_path.endswith(os.sep) else root_path + os.sep
-            search_pattern = search_pattern + "%"
-            
+        with _transaction(conn):
+            # Match all subpaths; the directory separator is included to avoid partial
+            # matches on directory names (e.g. /tmp/test matching /tmp/testing).
             # Also match the exact root path if it's a file
-            cursor = conn.execute(
-                "DELETE FROM documents_fts WHERE path = ? OR path LIKE ?", 
-                (root_path, search_pattern)
-            )
-            deleted_fts = cursor.rowcount
-
-            cursor = conn.execute(
-                "DELETE FROM documents_meta WHERE path = ? OR path LIKE ?", 
-                (root_path, search_pattern)
-            )
+            under_root = path_under_params(root_path)
+
+            total_count = conn.execute(
+                "SELECT count(*) FROM documents_meta"
+            ).fetchone()[0]
+            deleted_fts = conn.execute(
+                f"SELECT count(*) FROM documents_meta WHERE {PATH_UNDER_SQL}",
+                under_root,
+            ).fetchone()[0]
+
+            if deleted_fts > 0 and deleted_fts == total_count:
+                # Everything is under root_path: recreating the FTS table is far cheaper
+                # than deleting its rows one by one. Nothing to delete (an empty index)
+                # must not drop and rebuild the table.
+                conn.execute("DROP TABLE documents_fts")
+                conn.execute(FTS_TABLE_SQL)
+                conn.execute("DELETE FROM documents_meta")
+            else:
+                conn.execute(
+                    f"DELETE FROM documents_fts WHERE rowid IN (SELECT id FROM documents_meta WHERE {PATH_UNDER_SQL})",
+                    under_root,
+                )
+                conn.execute(
+                    f"DELETE FROM documents_meta WHERE {PATH_UNDER_SQL}", under_root
+                )
             
             return f"Deleted {deleted_fts} documents under {root_path}"
 
 
+def _format_match(path: str, line_number: int, snippet_bytes: bytes) -> str:
+    """Format one search hit; the snippet is decoded leniently and HTML-escaped."""
+    # Decode responsibly (replace errors), then sanitize HTML
+    snippet_str = snippet_bytes.decode("utf-8", errors="replace")
+    safe_snippet = html.escape(snippet_str)
+    return f"File: {path}:{line_number}\nSnippet: ...{safe_snippet}...\n"
+
+
+# Search statement. Both filters are always present and disabled by passing NULL,
+# so the SQL text is the same for every call and always hits sqlite3's statement cache.
+# The path filter is the PATH_UNDER_SQL range; extensions are a JSON array of suffixes.
+# tokens is the only indexed column, so the query matches the whole table and rank is
+# plain bm25() with no per-column weights to apply.
+SEARCH_SQL = """
+    SELECT 
+        path, 
+        highlight(documents_fts, 1, '{{{MATCH}}}', '{{{/MATCH}}}')
+    FROM documents_fts 
+    WHERE documents_fts MATCH :query
+        AND (:root IS NULL OR path = :root OR (path >= :prefix AND path < :prefix_end))
+        AND (:extensions IS NULL OR EXISTS (
+            SELECT 1 FROM json_each(:extensions) WHERE documents_fts.path LIKE '%' || json_each.value
+        ))
+    ORDER BY rank
+    LIMIT :limit
+"""
+
+
 @mcp.tool()
 def search_documents(
     query: str, 
@@ -436,65 +978,67 @@ def search_documents(
         extensions: List of file extensions to include (e.g., [".py", ".md"])
     """
 
-    # Tokenize the query to match the indexed format
-    query_token_data = tokenize(query)
-    # Extract surfaces for FTS MATCH query
-    # Sanitize tokens: Escape double quotes and wrap in double quotes to treat as string literals
+    # Tokenize the query to match the indexed format, as quoted FTS5 phrases.
     # This prevents FTS5 syntax injection (e.g. *, OR, NEAR, :, etc. inside words)
-    safe_surfaces = []
-    for t in query_token_data:
-        surface = t[0]
-        # Escape existing quotes by doubling them (standard SQL/FTS escaping)
-        surface_escaped = surface.replace('"', '""')
-        safe_surfaces.append(f'"{surface_escaped}"')
-    
-    if not safe_surfaces:
+    fts_query = build_fts_query(query)
+    if not fts_query:
         return ["No matches found."]
 
-    fts_query = " ".join(safe_surfaces)
     with get_db() as conn:
         # XSS Remediation: ...
         # XSS Remediation: Use safe placeholders for highlighting, then escape and replace in Python
         # Use offsets() to find which token matched
         # Note: We fetch tokens to count spaces for term index
-        sql = """
-            SELECT 
-                path, 
-                highlight(documents_fts, 2, '{{{MATCH}}}', '{{{/MATCH}}}'), 
-                tokens
-            FROM documents_fts 
-            WHERE tokens MATCH ? 
-        """
-        params = [fts_query]
+        params = {
+            "query": fts_query,
+            "root": None,
+            "prefix": None,
+            "prefix_end": None,
+            "extensions": None,
+            "limit": limit,
+        }
 
         if path_filter:
             path_filter = validate_path(path_filter)
             # Ensure proper separator for directory matching
-            filter_pattern = path_filter if path_filter.endswith(os.sep) else path_filter + os.sep
-            filter_pattern = filter_pattern + "%"
-            
-            sql += " AND (path = ? OR path LIKE ?)"
-            params.extend([path_filter, filter_pattern])
+            params["root"], params["prefix"], params["prefix_end"] = path_under_params(
+                path_filter
+            )
 
         if extensions:
-            # Construct OR clauses for extensions
-            # e.g. AND (path LIKE '%.py' OR path LIKE '%.md')
-            ext_clauses = []
-            for ext in extensions:
-                if not ext.startswith("."):
-                    ext = "." + ext
-                ext_clauses.append("path LIKE ?")
-                params.append(f"%{ext}")
-            
-            if ext_clauses:
-                sql += " AND (" + " OR ".join(ext_clauses) + ")"
+            # e.g. ["py", ".md"] -> '[".py", ".md"]', matched as path LIKE '%.py' OR ...
+            params["extensions"] = json.dumps(
+                [ext if ext.startswith(".") else "." + ext for ext in extensions]
+            )
 
-        sql += " ORDER BY rank LIMIT ?"
-        params.append(limit)
+        # Repeated searches against an unchanged index skip the query and the file reads
+        cache_key = (
+            _index_version,
+            conn.execute("PRAGMA data_version").fetchone()[0],
+            fts_query,
+            params["root"],
+            params["extensions"],
+            limit,
+        )
+        cached = _search_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+
+        # A filter with nothing indexed below it is answered by one path index probe
+        # instead of evaluating every MATCH hit against the range
+        if (
+            params["root"] is not None
+            and conn.execute(
+                f"SELECT 1 FROM documents_meta WHERE {PATH_UNDER_SQL} LIMIT 1",
+                (params["root"], params["prefix"], params["prefix_end"]),
+            ).fetchone()
+            is None
+        ):
+            return ["No matches found."]
 
-        cursor = conn.execute(sql, params)
+        cursor = conn.execute(SEARCH_SQL, params)
         rows = list(cursor)
-        
+
         if not rows:
             return ["No matches found."]
             
@@ -504,10 +1048,16 @@ def search_documents(
         
         placeholders = ",".join(["?"] * len(found_paths))
         meta_cursor = conn.execute(
-            f"SELECT path, token_locations FROM documents_meta WHERE path IN ({placeholders})",
+            f"SELECT path, token_deltas, token_locations, line_offsets FROM documents_meta WHERE path IN ({placeholders})",
             found_paths
         )
-        token_map_lookup = {r[0]: r[1] for r in meta_cursor}
+        delta_map_lookup = {}
+        token_map_lookup = {}
+        line_map_lookup = {}
+        for r in meta_cursor:
+            delta_map_lookup[r[0]] = r[1]
+            token_map_lookup[r[0]] = r[2]
+            line_map_lookup[r[0]] = r[3]
 
         results = []
         for row in rows:
@@ -516,102 +1066,105 @@ def search_documents(
             highlighted_tokens = row[1]
             
             # Lookup token locations map
+            token_deltas_blob = delta_map_lookup.get(path)
             token_locations_blob = token_map_lookup.get(path)
             
-            if not token_locations_blob:
+            if not token_deltas_blob and not token_locations_blob:
                 # Should not happen if index is consistent
                 continue
 
-            # Find all matches in highlighted_tokens
-            # Search for {{{MATCH}}}
-            # We need to find ALL start indices of {{{MATCH}}}
+            # Find the start indices of the first few {{{MATCH}}} markers
+            # Limit matches per file to avoid huge output
+            MAX_MATCHES_PER_FILE = 3
             match_indices = []
             start = 0
-            while True:
+            while len(match_indices) < MAX_MATCHES_PER_FILE:
                 idx = highlighted_tokens.find("{{{MATCH}}}", start)
                 if idx == -1:
                     break
                 match_indices.append(idx)
                 start = idx + len("{{{MATCH}}}")
-            
 
-            
-            # Limit matches per file to avoid huge output
-            MAX_MATCHES_PER_FILE = 3
-            match_indices = match_indices[:MAX_MATCHES_PER_FILE]
+            # Determine stride based on token count. highlight() only adds markers
+            # around tokens, so it has as many separating spaces as the tokens column
+            # and the column itself does not need to be fetched.
+            total_tokens = (
+                highlighted_tokens.count(" ") + 1 if highlighted_tokens else 0
+            )
+
+            if token_deltas_blob:
+                offset_at = functools.partial(token_offset_at, token_deltas_blob)
+            else:
+                # Indexed before token_deltas existed: fixed-width offsets
+                stride = 4
+                if total_tokens > 0:
+                    calculated_stride = len(token_locations_blob) // total_tokens
+                    if calculated_stride in (4, 8):
+                        stride = calculated_stride
+                offset_at = token_offsets_view(token_locations_blob, stride).__getitem__
+
+            # Map each match to the byte offset of its token. The tokens column is
+            # space-separated surfaces and highlight() only wraps them, so the token
+            # index is the number of spaces before the marker; count it incrementally.
+            byte_offsets = []
+            token_index = 0
+            prev = 0
+            for match_start in match_indices:
+                token_index += highlighted_tokens.count(" ", prev, match_start)
+                prev = match_start
+                if token_index < total_tokens:
+                    byte_offsets.append(offset_at(token_index))
+
+            if not byte_offsets:
+                continue
+
+            # Snippet Context: 100 bytes starting 50 bytes before each match
+            SNIPPET_CONTEXT_BYTES = 50
+            SNIPPET_BYTES = 100
+
+            line_offsets_blob = line_map_lookup.get(path)
 
             try:
                 with open(path, "rb") as f:
-                    for match_start in match_indices:
-                        # Calculate token index
-                        preceding_text = highlighted_tokens[:match_start]
-                        # Count spaces to get token index
-                        # Note: highlighted_tokens contains match tags, but since we scan left-to-right,
-                        # and we strip tags, or wait...
-                        # If we have multiple matches: "A {{{MATCH}}}B{{{/MATCH}}} C {{{MATCH}}}D{{{/MATCH}}}"
-                        # match_start for D is after B.
-                        # preceding_text for D includes "A {{{MATCH}}}B{{{/MATCH}}} C "
-                        # We must treat {{{MATCH}}} and {{{/MATCH}}} as transparent or NOT?
-                        # ACTUALLY: The tokens column is space-separated surfaces.
-                        # highlight() just wraps the surfaces.
-                        
-                        # Use split() to count tokens robustly (ignoring multiple spaces)
-                        # We assume tokens themselves do not contain spaces (which is true for our tokenizer surfaces)
-                        token_index = len(preceding_text.split())
-                        
-                        # Determine stride based on token count from stored tokens
-                        # row[2] is the 'tokens' column
-                        all_tokens_str = row[2]
-                        if not all_tokens_str:
-                            total_tokens = 0
-                        else:
-                            total_tokens = all_tokens_str.count(" ") + 1
-                        
-                        stride = 4
-                        if total_tokens > 0:
-                            calculated_stride = len(token_locations_blob) // total_tokens
-                            if calculated_stride in (4, 8):
-                                stride = calculated_stride
-                        
-                        if token_index < total_tokens:
-                            if stride == 8:
-                                byte_offset = struct.unpack_from("<Q", token_locations_blob, offset=token_index*8)[0]
-                            else:
-                                byte_offset = struct.unpack_from("<I", token_locations_blob, offset=token_index*4)[0]
-                            
-                            f.seek(0)
-                            # Read up to offset to count newlines
-                            prefix = f.read(byte_offset)
-                            line_number = prefix.count(b"\n") + 1
-                            
-                            # Read Snippet Context (e.g. 50 bytes before and after)
-                            # Be careful with UTF-8 distinct chars
-                            context_start = max(0, byte_offset - 50)
-                            context_len = 100 # Read 100 bytes approx
+                    if line_offsets_blob is not None:
+                        # Line numbers come from the newline table stored at index time,
+                        # so only the snippet windows are read from the file.
+                        line_ends = token_offsets_view(line_offsets_blob)
+                        for byte_offset in byte_offsets:
+                            line_number = (
+                                bisect.bisect_right(line_ends, byte_offset) + 1
+                            )
+                            context_start = max(0, byte_offset - SNIPPET_CONTEXT_BYTES)
                             f.seek(context_start)
-                            snippet_bytes = f.read(context_len)
-                            
-                            # Decode responsibly (replace errors)
-                            snippet_str = snippet_bytes.decode("utf-8", errors="replace")
-                            
-                            # Sanitize HTML
-                            safe_snippet = html.escape(snippet_str)
-                            
-                            # Highlight the match term roughly (simple string match might be wrong if multiple same words)
-                            # But since we don't have exact length of the token in bytes easily available here without more logic,
-                            # We can just show the plain snippet or try to highlight.
-                            # For now, let's trusting the offset line number is the most value.
-                            # We can refine snippet later if needed.
-                            # Just surrounding the whole snippet with "..."
-                            
-                            results.append(f"File: {path}:{line_number}\nSnippet: ...{safe_snippet}...\n")
-
+                            results.append(
+                                _format_match(path, line_number, f.read(SNIPPET_BYTES))
+                            )
+                    else:
+                        # Indexed before line_offsets existed: count newlines up to the
+                        # last match in one read that also covers the snippets.
+                        data = f.read(max(byte_offsets) + SNIPPET_BYTES)
+                        line_number = 1
+                        counted = 0
+                        for byte_offset in byte_offsets:
+                            # Offsets come in token order, so newlines are only counted once
+                            line_number += data.count(b"\n", counted, byte_offset)
+                            counted = byte_offset
+                            context_start = max(0, byte_offset - SNIPPET_CONTEXT_BYTES)
+                            snippet_bytes = data[
+                                context_start : context_start + SNIPPET_BYTES
+                            ]
+                            results.append(
+                                _format_match(path, line_number, snippet_bytes)
+                            )
             except (IOError, OSError, ValueError):
                 continue
 
+        if not results:
+            results = ["No matches found."]
 
-    if not results:
-        return ["No matches found."]
+        if len(_search_cache) >= SEARCH_CACHE_SIZE:
+            del _search_cache[next(iter(_search_cache))]
+        _search_cache[cache_key] = tuple(results)
 
     return results
 
@@ -635,7 +1188,7 @@ def list_indexed_files(limit: int = 100, offset: int = 0) -> List[str]:
 def update_file(file_path: str) -> str:
     """
     Update the index for a single file.
-    If the file exists, it is re-indexed.
+    If the file exists, it is re-indexed (unless it is unchanged since it was last indexed).
     If the file does not exist, it is removed from the index.
     """
     file_path = validate_path(file_path)
@@ -650,63 +1203,67 @@ def watch_directory(root_path: str) -> str:
     root_path = validate_path(root_path)
     if not os.path.exists(root_path):
         return f"Error: Path {root_path} does not exist."
-    
-    # Load .gitignore
-    gitignore_path = os.path.join(root_path, ".gitignore")
-    ignore_spec = None
-    if os.path.exists(gitignore_path):
-        try:
-            with open(gitignore_path, "r", encoding="utf-8") as f:
-                ignore_spec = pathspec.PathSpec.from_lines("gitignore", f)
-        except Exception as e:
-            print(f"Failed to load .gitignore: {e}", file=sys.stderr)
 
-    handler = FTSHandler(root_path, ignore_spec)
-    
     global observer
-    
-    # Check observer health first
-    # Reschedule all existing valid watches + the new one
-    if observer is None or not observer.is_alive():
-        if observer is not None:
-             # Observer existed but died.
-             pass 
-        
-        # Create new observer
-        observer = Observer()
-        
-        # Reschedule all existing valid watches
-        # Note: WATCHED_PATHS is now a dict {path: handler}
-        for path, h in WATCHED_PATHS.items():
-            if os.path.exists(path):
+
+    with _watch_lock:
+        # A stopped observer cannot be started again: replace it and reschedule the
+        # existing watches on the new one. A live observer is reused for every watch.
+        if observer is None or not observer.is_alive():
+            observer = Observer()
+            _watches.clear()
+            for path, h in WATCHED_PATHS.items():
+                if not os.path.exists(path):
+                    # Path might have been deleted while observer was down
+                    continue
                 try:
-                    observer.schedule(h, path, recursive=True)
+                    _watches[path] = observer.schedule(h, path, recursive=True)
                 except Exception as e:
-                    print(f"Failed to restore watch for {path}: {e}", file=sys.stderr)
-            else:
-                # Path might have been deleted while observer was down
-                pass
-        
-    # Check if already watching to avoid duplicates
-    if root_path in WATCHED_PATHS:
-        # Update handler (e.g. if gitignore changed)? 
-        return f"Already watching {root_path}"
+                    logger.warning("Failed to restore watch for %s: %s", path, e)
+            try:
+                observer.start()
+            except Exception as e:
+                return f"Failed to start watcher: {e}"
 
-    WATCHED_PATHS[root_path] = handler
-        
-    try:
-        if not observer.is_alive():
-            observer.start()
+        # Check if already watching to avoid duplicates
+        if root_path in WATCHED_PATHS:
+            return f"Already watching {root_path}"
+
+        # Load .gitignore
+        gitignore_path = os.path.join(root_path, ".gitignore")
+        ignore_spec = None
+        if os.path.exists(gitignore_path):
+            try:
+                with open(gitignore_path, "r", encoding="utf-8") as f:
+                    ignore_spec = pathspec.PathSpec.from_lines("gitignore", f)
+            except Exception as e:
+                logger.warning("Failed to load .gitignore: %s", e)
 
-        observer.schedule(handler, root_path, recursive=True)
+        handler = FTSHandler(root_path, ignore_spec)
+        try:
+            _watches[root_path] = observer.schedule(handler, root_path, recursive=True)
+        except Exception as e:
+            return f"Failed to start watcher: {e}"
+        WATCHED_PATHS[root_path] = handler
 
-    except Exception as e:
-        # Fallback if something goes wrong
-        return f"Failed to start watcher: {e}"
-        
     return f"Started watching {root_path} for changes."
 
 
+@mcp.tool()
+def unwatch_directory(root_path: str) -> str:
+    """
+    Stop watching a directory. Documents already indexed from it are kept.
+    """
+    root_path = validate_path(root_path)
+
+    with _watch_lock:
+        if WATCHED_PATHS.pop(root_path, None) is None:
+            return f"Not watching {root_path}"
+        watch = _watches.pop(root_path, None)
+        if watch is not None and observer is not None and observer.is_alive():
+            observer.unschedule(watch)
+
+    return f"Stopped watching {root_path}"
 
 
 @mcp.tool()
@@ -717,7 +1274,10 @@ def get_index_stats() -> str:
     - total_files: Number of indexed files
     - total_size_bytes: Size of the SQLite database file
     - last_scanned: Timestamp of the most recent indexing operation
+      (an index_directory run or a single-file update)
     - watched_directories: List of directories currently being watched
+    - recent_files: The most recently (re)written documents; files found
+      unchanged by a re-index keep the time they were last written
     """
     stats = {
         "version": "unknown",
@@ -735,14 +1295,20 @@ def get_index_stats() -> str:
     
     with get_db() as conn:
         # Get counts and timestamps
-        row = conn.execute("SELECT count(*), MAX(scanned_at) FROM documents_meta").fetchone()
+        row = conn.execute(
+            "SELECT count(*), MAX(scanned_at), (SELECT MAX(finished_at) FROM index_runs) FROM documents_meta"
+        ).fetchone()
         if row:
             stats["total_files"] = row[0]
-            if row[1]:
+            # The latest full pass, or a later single-file (watcher) update
+            last_scanned = max((t for t in row[1:] if t is not None), default=None)
+            if last_scanned:
                 from datetime import datetime, timezone
                 # Convert unix timestamp to ISO 8601 string (UTC)
-                stats["last_scanned"] = datetime.fromtimestamp(row[1], tz=timezone.utc).isoformat()
-        
+                stats["last_scanned"] = datetime.fromtimestamp(
+                    last_scanned, tz=timezone.utc
+                ).isoformat()
+
         # Get list of unique directory paths containing indexed files
         # Since we don't store "root" paths separately, we infer them from file paths.
         path_rows = conn.execute("SELECT path FROM documents_meta").fetchall()
@@ -765,7 +1331,7 @@ def get_index_stats() -> str:
         except sqlite3.Error as e:
             stats["db_integrity"] = str(e)
             
-        # Get recently indexed files
+        # Get the most recently (re)written files
         recent_rows = conn.execute("SELECT path, scanned_at FROM documents_meta ORDER BY scanned_at DESC LIMIT 5").fetchall()
         stats["recent_files"] = []
         from datetime import datetime, timezone
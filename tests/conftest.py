@@ -4,13 +4,16 @@ import sqlite3
 from unittest.mock import patch
 
 import pytest
-from sudachipy import dictionary, tokenizer
+from sudachipy import tokenizer
 
 
-# Session-scoped tokenizer to avoid reloading dictionary
+# Session-scoped tokenizer to avoid reloading dictionary: the documents module already
+# loads one at import, so the tests share its dictionary instead of opening another
 @pytest.fixture(scope="session")
 def tokenizer_obj():
-    return dictionary.Dictionary().create()
+    from mcp_jp_fts import documents
+
+    return documents.get_tokenizer()
 
 
 @pytest.fixture(scope="session")
@@ -37,26 +40,78 @@ def temp_db(tmp_path):
     db_file = tmp_path / "test_documents.db"
 
     conn = sqlite3.connect(db_file)
+    # Same journal mode as init_db, so test connections never block the server's writers
+    conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("""
         CREATE VIRTUAL TABLE documents_fts USING fts5(
-            path,
-            content,
+            path UNINDEXED,
             tokens,
-            tokenize='unicode61'
+            tokenize='unicode61 remove_diacritics 2'
         );
     """)
     conn.execute("""
         CREATE TABLE documents_meta (
-            path TEXT PRIMARY KEY,
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
             mtime REAL,
             scanned_at REAL,
-            token_locations BLOB
+            token_locations BLOB,
+            line_offsets BLOB,
+            token_deltas BLOB,
+            content_hash BLOB
         );
     """)
     conn.close()
     return str(db_file)
 
 
+@pytest.fixture
+def db_conn(temp_db):
+    """
+    One autocommit connection to temp_db for a test's assertions, instead of
+    reconnecting for every check.
+    """
+    conn = sqlite3.connect(temp_db, isolation_level=None)
+    # Same per-connection settings as the server's get_db() (the file is already WAL)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    yield conn
+    conn.close()
+
+
+@pytest.fixture(scope="session")
+def indexed_resource_dir(tmp_path_factory):
+    """
+    A session-wide copy of the test resources, indexed once into base.db next to it.
+    Tokenizing the resources is the slowest part of most tests, so read-only tests
+    start from a copy of this index (see indexed_db) instead of re-indexing.
+    """
+    # Imported here so that test_server.py imports the module first, with FastMCP patched
+    from mcp_jp_fts import server
+
+    base = tmp_path_factory.mktemp("indexed")
+    dst = base / "resources"
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "resources"), dst)
+    with patch("mcp_jp_fts.server.DB_PATH", str(base / "base.db")):
+        server.index_directory(str(dst))
+        # Closing the last connection checkpoints the WAL into base.db
+        server.close_db()
+    return str(dst)
+
+
+@pytest.fixture
+def indexed_db(indexed_resource_dir, tmp_path):
+    """
+    Path to a private copy of the index of indexed_resource_dir,
+    so a test may query (or modify) it freely.
+    """
+    db_file = tmp_path / "indexed.db"
+    shutil.copyfile(
+        os.path.join(os.path.dirname(indexed_resource_dir), "base.db"), db_file
+    )
+    return str(db_file)
+
+
 @pytest.fixture
 def resource_dir(tmp_path):
     """
@@ -66,3 +121,24 @@ def resource_dir(tmp_path):
     dst = tmp_path / "resources"
     shutil.copytree(src, dst)
     return str(dst)
+
+
+@pytest.fixture
+def watch_state():
+    """
+    Start and end a test with no watched directories and no running observer, so
+    that watches scheduled by one test never fire into another's database.
+    """
+    from mcp_jp_fts import server
+
+    def reset():
+        with server._watch_lock:
+            if server.observer is not None and server.observer.is_alive():
+                server.observer.stop()
+                server.observer.join()
+            server.WATCHED_PATHS.clear()
+            server._watches.clear()
+
+    reset()
+    yield
+    reset()
@@ -1,8 +1,14 @@
+import logging
 import os
 import sqlite3
+import struct
+import subprocess
+import sys
 import time
 from unittest.mock import patch
 
+import pytest
+
 
 # Helper to mock the decorator to return the original function
 def identity_decorator(func):
@@ -17,7 +23,23 @@ with patch("fastmcp.FastMCP") as MockFastMCP:
 
     # Now import server
     # sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-    from mcp_jp_fts import server
+    from mcp_jp_fts import documents, server
+
+
+def assert_offsets_match(text, tokens):
+    """Each token surface must occur in the UTF-8 encoded text at its reported byte offset."""
+    text_bytes = text.encode("utf-8")
+    mismatched = [
+        (s, o) for s, o in tokens if not text_bytes.startswith(s.encode("utf-8"), o)
+    ]
+    assert not mismatched, mismatched[:5]
+
+
+def write_files(pairs):
+    """Create each (path, text) file, UTF-8 encoded."""
+    for path, text in pairs:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
 
 
 def test_tokenize():
@@ -36,16 +58,209 @@ def test_tokenize():
 
     # Verify exact match positions (Negative Offset Check)
     # Ensure that the surface string actually exists at the reported byte offset in the original text
-    text_bytes = text.encode("utf-8")
-    for surface, offset in tokens:
-        surface_bytes = surface.encode("utf-8")
-        assert text_bytes[offset : offset + len(surface_bytes)] == surface_bytes
+    assert_offsets_match(text, tokens)
 
 
     surfaces = [t[0] for t in tokens]
     assert "猫" in surfaces
 
 
+def test_tokenize_keeps_numbers_whole():
+    # Numbers are single tokens, so a query for "2024" does not match any 2, 0 and 4
+    tokens = server.tokenize("西暦2024年の記録 3.10")
+    assert [s for s, _ in tokens] == ["西暦", "2024", "年", "の", "記録", " ", "3.10"]
+    assert server.build_fts_query("2024年") == '"2024" "年"'
+
+
+def test_token_offsets_view():
+    offsets = [0, 6, 1 << 40]
+    view = server.token_offsets_view(struct.pack("<3Q", *offsets))
+    assert list(view) == offsets
+
+    legacy = server.token_offsets_view(struct.pack("<2I", 0, 6), stride=4)
+    assert list(legacy) == [0, 6]
+
+
+def test_pack_token_offsets_roundtrip():
+    # One-byte deltas take the fast path; a large gap forces multi-byte varints
+    small = list(range(0, 3 * 200, 3))
+    large = (
+        small + [1 << 33, (1 << 33) + 5] + [(1 << 33) + 300 * i for i in range(2, 150)]
+    )
+    for offsets in (small, large):
+        blob = documents.pack_token_offsets(offsets)
+        assert [server.token_offset_at(blob, i) for i in range(len(offsets))] == offsets
+
+    # Roughly one byte per token plus the sample table, instead of eight
+    assert len(documents.pack_token_offsets(small)) < 2 * len(small)
+    assert documents.pack_token_offsets([]) == struct.pack("<I", 0)
+
+
+def test_tokenize_query_cached():
+    server.tokenize_query.cache_clear()
+
+    tokens = server.tokenize_query("吾輩は猫である")
+    assert list(tokens) == server.tokenize("吾輩は猫である")
+
+    assert server.tokenize_query("吾輩は猫である") is tokens
+    assert server.tokenize_query.cache_info().hits == 1
+
+
+def test_build_fts_query_strips_syntax():
+    assert server.build_fts_query("東京 OR 大阪") == '"東京" "OR" "大阪"'
+    assert server.build_fts_query('say "hi"*') == '"say" "hi"'
+    # Only FTS5 syntax characters: nothing left to search
+    assert server.build_fts_query("(*)") == ""
+
+
+def test_search_documents_with_fts_syntax(temp_db, resource_dir):
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        server.index_directory(resource_dir)  # type: ignore
+        assert server.search_documents('"(*:^') == ["No matches found."]  # type: ignore
+        server.search_documents("猫 NEAR(犬) -鳥")  # type: ignore
+
+
+def test_tokenize_long_text():
+    """Texts beyond SudachiPy's input limit are tokenized in chunks with global byte offsets."""
+    line = "吾輩は猫である。名前はまだ無い。\n"
+    text = line * 2000
+    assert len(text.encode("utf-8")) > documents.SUDACHI_MAX_INPUT_BYTES
+
+    tokens = server.tokenize(text)
+
+    assert_offsets_match(text, tokens)
+
+    assert sum(1 for t in tokens if t[0] == "猫") == 2000
+
+
+def test_tokenize_offsets_with_gaps():
+    """Windows whose tokens skip characters fall back to per-token offset tracking."""
+
+    class SpaceDroppingTokenizer:
+        # Wraps the real tokenizer but omits whitespace morphemes, leaving gaps
+        def __init__(self, inner):
+            self.inner = inner
+
+        def tokenize(self, text):
+            return [m for m in self.inner.tokenize(text) if m.surface().strip()]
+
+    text = "吾輩は 猫 である。\n名前は  まだ無い。"
+    with patch(
+        "mcp_jp_fts.documents.get_tokenizer",
+        return_value=SpaceDroppingTokenizer(documents.get_tokenizer()),
+    ):
+        tokens = server.tokenize(text)
+
+    assert [s for s, _ in tokens if s.strip()] == [
+        s for s, _ in server.tokenize(text) if s.strip()
+    ]
+    assert_offsets_match(text, tokens)
+
+
+def test_tokenize_chunks_ascii_windows():
+    text = "print('hello world')\n" * 5000
+    chunks = list(documents.tokenize_chunks(text))
+
+    assert "".join(chunks) == text
+    assert all(
+        len(c.encode("utf-8")) <= documents.SUDACHI_MAX_INPUT_BYTES for c in chunks
+    )
+    assert all(c.endswith("\n") for c in chunks)
+    # Pure ASCII windows are not limited to the 4-bytes-per-character worst case
+    assert len(chunks[0]) > documents.TOKENIZE_CHUNK_CHARS
+
+
+def test_tokenize_mixed_ascii_chunks():
+    """Offsets stay global when ASCII and non-ASCII windows alternate."""
+    text = (
+        "def main():\n    return 0\n" * 3000
+        + "吾輩は猫である。\n" * 2000
+        + "end of file\n" * 3000
+    )
+    tokens = server.tokenize(text)
+
+    assert_offsets_match(text, tokens)
+
+
+def test_read_text_file(tmp_path):
+    file_path = tmp_path / "text.txt"
+    file_path.write_bytes("吾輩は猫である\r\n名前はまだ無い".encode("utf-8"))
+
+    assert (
+        documents.read_text_file(str(file_path)) == "吾輩は猫である\r\n名前はまだ無い"
+    )
+
+    # Reading past the sniffed head in small chunks must give the same result
+    with (
+        patch("mcp_jp_fts.documents.BINARY_SNIFF_BYTES", 4),
+        patch("mcp_jp_fts.documents.READ_CHUNK_BYTES", 5),
+    ):
+        assert (
+            documents.read_text_file(str(file_path))
+            == "吾輩は猫である\r\n名前はまだ無い"
+        )
+
+
+def test_tokenize_file_streams_blocks(tmp_path):
+    """Streaming tokenization matches tokenizing the whole text, across block boundaries."""
+    # An odd-length ASCII prefix makes multibyte characters straddle the read blocks
+    text = "x" + "吾輩は猫である。名前はまだ無い。\n" * 20000
+    p = tmp_path / "large.txt"
+    p.write_text(text, encoding="utf-8")
+    assert p.stat().st_size > 2 * documents.READ_CHUNK_BYTES
+
+    pieces = list(documents.iter_text_file(str(p)))
+    assert len(pieces) > 1
+    assert "".join(pieces) == text
+    assert documents.tokenize_file(str(p)) == server.tokenize(text)
+
+
+def test_tokenize_file_records_line_ends(tmp_path):
+    text = (
+        "print('ascii')\n" * 5000
+        + "吾輩は猫である。\r\n" * 5000
+        + "no trailing newline"
+    )
+    p = tmp_path / "lines.txt"
+    p.write_text(text, encoding="utf-8", newline="")
+
+    line_ends = []
+    documents.tokenize_file(str(p), line_ends)
+
+    data = text.encode("utf-8")
+    expected = [i + 1 for i, b in enumerate(data) if b == 0x0A]
+    assert line_ends == expected
+
+
+def test_iter_text_file_rejects_late_invalid_utf8(tmp_path):
+    p = tmp_path / "late_invalid.txt"
+    p.write_bytes(b"a\n" * documents.READ_CHUNK_BYTES + b"\xff\xfe")
+
+    with pytest.raises(UnicodeDecodeError):
+        documents.read_text_file(str(p))
+
+
+def test_read_text_file_rejects_binary(tmp_path):
+    file_path = tmp_path / "binary.dat"
+    file_path.write_bytes(b"SQLite format 3\x00" + b"a" * 100)
+
+    with pytest.raises(UnicodeDecodeError):
+        documents.read_text_file(str(file_path))
+
+
+def test_tokenize_from_multiple_threads():
+    """Each thread uses its own SudachiPy tokenizer, so concurrent calls do not fail."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    text = "吾輩は猫である。名前はまだ無い。\n" * 200
+    expected = server.tokenize(text)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(server.tokenize, [text] * 8))
+
+    assert all(r == expected for r in results)
+
+
 def test_validate_path_security():
     """
     Test that validate_path restricts access to the current working directory.
@@ -59,15 +274,74 @@ def test_validate_path_security():
 
     # Outside CWD should now be ALLOWED
     unsafe_path = "/etc/passwd"
-    assert server.validate_path(unsafe_path) == os.path.abspath("/etc/passwd")
+    assert server.validate_path(unsafe_path) == "/etc/passwd"
 
-    # Relative paths resolve to absolute
+    # Relative paths resolve to absolute, against the cwd read once above
     unsafe_rel = "../../outside.txt"
-    expected = os.path.abspath(unsafe_rel)
+    expected = os.path.normpath(os.path.join(cwd, unsafe_rel))
     assert server.validate_path(unsafe_rel) == expected
 
 
-def test_index_directory_clears_stale_data(temp_db, resource_dir):
+def test_get_db_reuses_connection(temp_db, tmp_path):
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        with server.get_db() as conn1:
+            pass
+        with server.get_db() as conn2:
+            pass
+        assert conn1 is conn2
+
+    # Switching DB_PATH opens a fresh connection
+    other_db = str(tmp_path / "other.db")
+    with patch("mcp_jp_fts.server.DB_PATH", other_db):
+        with server.get_db() as conn3:
+            assert conn3 is not conn1
+            assert (
+                conn3.execute("SELECT count(*) FROM documents_meta").fetchone()[0] == 0
+            )
+
+
+def test_close_db(tmp_path):
+    db_path = str(tmp_path / "close.db")
+    with patch("mcp_jp_fts.server.DB_PATH", db_path):
+        with server.get_db() as conn:
+            pass
+        server.close_db()
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+        # Closing twice is a no-op, and the next call reconnects
+        server.close_db()
+        with server.get_db() as conn2:
+            assert conn2 is not conn
+
+
+def test_get_db_tuning(tmp_path):
+    db_path = str(tmp_path / "tuning.db")
+    with patch("mcp_jp_fts.server.DB_PATH", db_path):
+        with server.get_db() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert conn.execute("PRAGMA page_size").fetchone()[0] == 8192
+            assert conn.execute("PRAGMA mmap_size").fetchone()[0] == 268435456
+
+
+def test_transaction_rolls_back(tmp_path):
+    db_path = str(tmp_path / "txn.db")
+    with patch("mcp_jp_fts.server.DB_PATH", db_path):
+        with server.get_db() as conn:
+            # Transactions are explicit; nothing is left open between calls
+            assert conn.isolation_level is None
+            with pytest.raises(RuntimeError):
+                with server._transaction(conn):
+                    conn.execute(
+                        "INSERT INTO documents_meta (path) VALUES ('/tmp/rolled-back.txt')"
+                    )
+                    raise RuntimeError
+            assert not conn.in_transaction
+            assert (
+                conn.execute("SELECT count(*) FROM documents_meta").fetchone()[0] == 0
+            )
+
+
+def test_index_directory_clears_stale_data(temp_db, db_conn, resource_dir):
     # Patch server.DB_PATH to use temp_db
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         # 1. Initial Index
@@ -75,47 +349,178 @@ def test_index_directory_clears_stale_data(temp_db, resource_dir):
         assert "Indexed" in result
 
         # Verify content
-        with sqlite3.connect(temp_db) as conn:
-            count = conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0]
-            assert count >= 2  # wagahai.txt and yukiguni.txt
-
-            # Check for specific content
-            rows = conn.execute("SELECT path, tokens FROM documents_fts").fetchall()
-            paths = [r[0] for r in rows]
-            assert any("wagahai.txt" in p for p in paths)
+        # One query for both the row count and the content check
+        paths = [r[0] for r in db_conn.execute("SELECT path FROM documents_fts")]
+        assert len(paths) >= 2  # wagahai.txt and yukiguni.txt
+        assert any("wagahai.txt" in p for p in paths)
 
         # 2. Simulate existing stale data (a file that no longer exists in resource_dir)
         stale_path = os.path.join(resource_dir, "stale_file.txt")
-        with sqlite3.connect(temp_db) as conn:
-            conn.execute(
-                "INSERT INTO documents_fts (path, content, tokens) VALUES (?, ?, ?)",
-                (stale_path, "stale content", "stale tokens"),
-            )
-            # Also insert into meta with old timestamp
-            conn.execute(
+        # Insert into meta with old timestamp; the FTS row shares its id.
+        # Both rows go in one write transaction, as the server writes them.
+        with server._transaction(db_conn):
+            cursor = db_conn.execute(
                 "INSERT INTO documents_meta (path, mtime, scanned_at) VALUES (?, ?, ?)",
                 (stale_path, 1000.0, 1000.0),
             )
-            count = conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0]
-            assert count >= 3
+            db_conn.execute(
+                "INSERT INTO documents_fts (rowid, path, tokens) VALUES (?, ?, ?)",
+                (cursor.lastrowid, stale_path, "stale tokens"),
+            )
+        count = db_conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0]
+        assert count >= 3
 
         # 3. Re-index
         result = server.index_directory(resource_dir)  # type: ignore
 
         # 4. Verify stale data is gone
-        with sqlite3.connect(temp_db) as conn:
-            count = conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0]
-            assert count == 4
+        paths = [r[0] for r in db_conn.execute("SELECT path FROM documents_fts")]
+        assert len(paths) == 4
+        assert not any("stale_file.txt" in p for p in paths)
 
-            rows = conn.execute("SELECT path FROM documents_fts").fetchall()
-            paths = [r[0] for r in rows]
-            assert not any("stale_file.txt" in p for p in paths)
 
-
-def test_search_documents(temp_db, resource_dir):
+def test_unchanged_reindex_writes_nothing(temp_db, resource_dir):
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         server.index_directory(resource_dir)  # type: ignore
+        version = server._index_version
+
+        result = server.index_directory(resource_dir)  # type: ignore
+
+        assert "Indexed 0" in result and "Deleted 0" in result
+        # No document write transaction was committed for the unchanged files
+        assert server._index_version == version
+
+
+def test_get_index_stats_reports_last_run(temp_db, tmp_path):
+    """A re-index that finds nothing changed still advances last_scanned."""
+    import json
+
+    (tmp_path / "f1.txt").write_text("Hello", encoding="utf-8")
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        with patch("time.time", return_value=1000.0):
+            server.index_directory(str(tmp_path))  # type: ignore
+        with patch("time.time", return_value=2000.0):
+            result = server.index_directory(str(tmp_path))  # type: ignore
+        assert "Indexed 0" in result
+
+        stats = json.loads(server.get_index_stats())
+        assert stats["last_scanned"] == "1970-01-01T00:33:20+00:00"
+        # The unchanged file keeps the time it was written
+        assert stats["recent_files"][0]["timestamp"] == "1970-01-01T00:16:40+00:00"
+
+
+def test_index_directory_releases_db_lock_while_tokenizing(temp_db, tmp_path):
+    """Other threads (watcher, tool calls) can use the database while files are loaded."""
+    import threading
+
+    (tmp_path / "a.txt").write_text("吾輩は猫である", encoding="utf-8")
+    acquired = []
+    real_load = server._load_for_index
+
+    def load_and_probe(candidate):
+        def probe():
+            if server._db_lock.acquire(timeout=5):
+                server._db_lock.release()
+                acquired.append(True)
+
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        return real_load(candidate)
+
+    with (
+        patch("mcp_jp_fts.server.DB_PATH", temp_db),
+        patch("mcp_jp_fts.server._load_for_index", load_and_probe),
+    ):
+        result = server.index_directory(str(tmp_path))  # type: ignore
+
+    assert "Indexed 1 files" in result
+    assert acquired == [True]
+
+
+def test_older_mtime_content_is_reindexed(temp_db, tmp_path):
+    """Content restored with an older mtime (cp -p, tar x, git checkout) is not treated as unchanged."""
+    target = tmp_path / "restored.txt"
+    target.write_text("吾輩は猫である", encoding="utf-8")
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        server.index_directory(str(tmp_path))  # type: ignore
+
+        old_mtime = os.stat(target).st_mtime - 3600
+        target.write_text("雪国であった", encoding="utf-8")
+        os.utime(target, (old_mtime, old_mtime))
+        assert server.update_file(str(target)).startswith("Updated")  # type: ignore
+        assert any("restored.txt" in r for r in server.search_documents("雪国"))  # type: ignore
+
+        target.write_text("銀河鉄道の夜", encoding="utf-8")
+        os.utime(target, (old_mtime - 3600, old_mtime - 3600))
+        assert "Indexed 1 files" in server.index_directory(str(tmp_path))  # type: ignore
+        assert any("restored.txt" in r for r in server.search_documents("銀河"))  # type: ignore
+
+
+def test_index_optimizes_after_bulk_changes(temp_db, tmp_path):
+    d = tmp_path / "optimize_resources"
+    d.mkdir()
+    for i in range(4):
+        (d / f"doc{i}.txt").write_text(f"文書{i}", encoding="utf-8")
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        statements = []
+        with server.get_db() as conn:
+            conn.set_trace_callback(statements.append)
+        try:
+            # First-time index: everything changed, so the index is fully optimized
+            server.index_directory(str(d))  # type: ignore
+            assert any("'optimize'" in s for s in statements)
+
+            # One changed file out of four only gets an incremental merge
+            statements.clear()
+            (d / "doc0.txt").write_text("更新", encoding="utf-8")
+            # Explicitly newer, independent of the filesystem's mtime granularity
+            future_mtime = time.time() + 10
+            os.utime(d / "doc0.txt", (future_mtime, future_mtime))
+            server.index_directory(str(d))  # type: ignore
+            assert not any("'optimize'" in s for s in statements)
+            assert any("'merge'" in s for s in statements)
+        finally:
+            with server.get_db() as conn:
+                conn.set_trace_callback(None)
+
 
+def test_index_with_worker_processes(temp_db, tmp_path):
+    d = tmp_path / "pool_resources"
+    d.mkdir()
+    for i in range(3):
+        (d / f"doc{i}.txt").write_text(f"吾輩は猫である{i}", encoding="utf-8")
+    (d / "binary.txt").write_bytes(b"\x00\x01")
+
+    with (
+        patch("mcp_jp_fts.server.DB_PATH", temp_db),
+        patch("mcp_jp_fts.server.INDEX_WORKERS", 2),
+        patch("mcp_jp_fts.server.PROCESS_POOL_MIN_FILES", 1),
+    ):
+        result = server.index_directory(str(d))  # type: ignore
+        assert "Indexed 3 files" in result
+
+        results = server.search_documents("猫", limit=10)  # type: ignore
+    assert len(results) == 3
+
+
+def test_index_workers_do_not_import_server():
+    # Spawned workers import the console script's module and documents; neither may
+    # pull in the server with its FastMCP, watchdog observer and log listener
+    code = (
+        "import sys, mcp_jp_fts, mcp_jp_fts.documents; "
+        "print(sorted(m for m in ('mcp_jp_fts.server', 'fastmcp', 'watchdog')"
+        " if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def test_search_documents(indexed_db):
+    with patch("mcp_jp_fts.server.DB_PATH", indexed_db):
         results = server.search_documents("猫")  # type: ignore
         assert len(results) > 0
         assert any("wagahai.txt" in r for r in results)
@@ -128,44 +533,53 @@ def test_search_documents(temp_db, resource_dir):
         assert results == ["No matches found."]
 
 
-def test_search_tokenization(temp_db, resource_dir):
-    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
-        server.index_directory(resource_dir)  # type: ignore
-
+def test_search_tokenization(indexed_db):
+    with patch("mcp_jp_fts.server.DB_PATH", indexed_db):
         results = server.search_documents("トンネル")  # type: ignore
         assert len(results) > 0
         assert any("yukiguni.txt" in r for r in results)
 
 
-def test_delete_index(temp_db, resource_dir):
+def test_delete_index(temp_db, db_conn, resource_dir):
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         # Index everything
         server.index_directory(resource_dir)  # type: ignore
 
+        # Both tables are counted in one statement
+        counts_sql = "SELECT (SELECT count(*) FROM documents_fts), (SELECT count(*) FROM documents_meta)"
+
         # Verify indexed
-        with sqlite3.connect(temp_db) as conn:
-            count_before = conn.execute(
-                "SELECT count(*) FROM documents_fts"
-            ).fetchone()[0]
-            assert count_before >= 2
+        fts_before, meta_before = db_conn.execute(counts_sql).fetchone()
+        assert fts_before >= 2
+        assert meta_before == fts_before
 
         # Delete from a specific subdirectory (if we had one) or the whole thing
         # Let's delete the whole resource_dir
         result = server.delete_index(resource_dir)  # type: ignore
         assert "Deleted" in result
 
-        # Verify empty
-        with sqlite3.connect(temp_db) as conn:
-            count_after = conn.execute("SELECT count(*) FROM documents_fts").fetchone()[
-                0
-            ]
-            assert count_after == 0
+        # Verify empty: the FTS rows and their metadata are both gone
+        assert db_conn.execute(counts_sql).fetchone() == (0, 0)
 
 
-def test_search_documents_with_filter(temp_db, resource_dir):
+def test_delete_index_empty_keeps_fts_table(temp_db, tmp_path):
+    statements = []
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
-        server.index_directory(resource_dir)  # type: ignore
+        with server.get_db() as conn:
+            conn.set_trace_callback(statements.append)
+        try:
+            result = server.delete_index(str(tmp_path))  # type: ignore
+        finally:
+            with server.get_db() as conn:
+                conn.set_trace_callback(None)
+
+    assert result == f"Deleted 0 documents under {tmp_path}"
+    assert not any("DROP TABLE" in s for s in statements)
 
+
+def test_search_documents_with_filter(indexed_db, indexed_resource_dir):
+    resource_dir = indexed_resource_dir
+    with patch("mcp_jp_fts.server.DB_PATH", indexed_db):
         # Test query "猫" (exists in root wagahai.txt)
         query = "猫"
 
@@ -195,6 +609,24 @@ def test_search_documents_with_filter(temp_db, resource_dir):
         assert results == ["No matches found."]
 
 
+def test_search_unindexed_path_filter_skips_match(indexed_db, indexed_resource_dir):
+    statements = []
+    with patch("mcp_jp_fts.server.DB_PATH", indexed_db):
+        with server.get_db() as conn:
+            conn.set_trace_callback(statements.append)
+        try:
+            dummy_path = os.path.join(
+                os.path.dirname(indexed_resource_dir), "non_existent_dir"
+            )
+            results = server.search_documents("猫", path_filter=dummy_path)  # type: ignore
+        finally:
+            with server.get_db() as conn:
+                conn.set_trace_callback(None)
+
+    assert results == ["No matches found."]
+    assert not any("MATCH" in s for s in statements)
+
+
 def test_delete_index_subdirectory(temp_db, resource_dir):
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         server.index_directory(resource_dir)  # type: ignore
@@ -217,10 +649,32 @@ def test_delete_index_subdirectory(temp_db, resource_dir):
         assert any("kokoro.txt" in r for r in results)
 
 
-def test_list_indexed_files(temp_db, resource_dir):
+def test_path_filters_are_literal(temp_db, tmp_path):
+    """Path prefixes match literally: no LIKE wildcards and no case folding."""
+    for name in ("my_dir", "myXdir", "Case", "case"):
+        d = tmp_path / "literal" / name
+        d.mkdir(parents=True)
+        (d / "doc.txt").write_text("吾輩は猫である", encoding="utf-8")
+    root = str(tmp_path / "literal")
+
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
-        server.index_directory(resource_dir)  # type: ignore
+        server.index_directory(root)  # type: ignore
 
+        results = server.search_documents(
+            "猫", path_filter=os.path.join(root, "my_dir")
+        )  # type: ignore
+        assert len(results) == 1
+        assert "my_dir" in results[0]
+
+        server.delete_index(os.path.join(root, "Case"))  # type: ignore
+        files = server.list_indexed_files()  # type: ignore
+        assert os.path.join(root, "case", "doc.txt") in files
+        assert os.path.join(root, "Case", "doc.txt") not in files
+        assert len(files) == 3
+
+
+def test_list_indexed_files(indexed_db):
+    with patch("mcp_jp_fts.server.DB_PATH", indexed_db):
         files = server.list_indexed_files()  # type: ignore
         assert len(files) >= 4  # wagahai, yukiguni, ginga, kokoro
 
@@ -236,6 +690,28 @@ def test_list_indexed_files(temp_db, resource_dir):
         assert len(files_limited) == 1
 
 
+def test_search_results_cached_until_index_changes(temp_db, tmp_path):
+    d = tmp_path / "cache_resources"
+    d.mkdir()
+    p = d / "cached.txt"
+    p.write_text("東京タワーに行く", encoding="utf-8")
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        server.index_directory(str(d))  # type: ignore
+        first = server.search_documents("東京")  # type: ignore
+
+        # Without a write to the index the cached result is returned as is
+        p.write_text("東京スカイツリーに行く", encoding="utf-8")
+        os.utime(p, (time.time() + 10, time.time() + 10))
+        assert server.search_documents("東京") == first  # type: ignore
+
+        server.update_file(str(p))  # type: ignore
+        second = server.search_documents("東京")  # type: ignore
+
+    assert "タワー" in first[0]
+    assert "スカイツリー" in second[0]
+
+
 def test_index_respects_gitignore(temp_db, resource_dir):
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         # Create .gitignore
@@ -243,20 +719,20 @@ def test_index_respects_gitignore(temp_db, resource_dir):
         with open(gitignore_path, "w", encoding="utf-8") as f:
             f.write("*.tmp\nignore_me.txt\n")
 
-        # Create ignored files
-        with open(os.path.join(resource_dir, "test.tmp"), "w") as f:
-            f.write("ignored content")
-        with open(os.path.join(resource_dir, "ignore_me.txt"), "w") as f:
-            f.write("ignored content")
+        # Create ignored files and a normal file
+        write_files(
+            [
+                (os.path.join(resource_dir, "test.tmp"), "ignored content"),
+                (os.path.join(resource_dir, "ignore_me.txt"), "ignored content"),
+                (os.path.join(resource_dir, "normal.txt"), "normal content"),
+            ]
+        )
 
-        # Create normal file
-        with open(os.path.join(resource_dir, "normal.txt"), "w") as f:
-            f.write("normal content")
+        # Index: the four resource texts plus normal.txt, nothing ignored
+        res = server.index_directory(resource_dir)  # type: ignore
+        assert res.startswith("Indexed 5 files")
 
-        # Index
-        server.index_directory(resource_dir)  # type: ignore
-
-        # Verify
+        # Verify (a single listing query)
         files = server.list_indexed_files()  # type: ignore
         basenames = [os.path.basename(f) for f in files]
 
@@ -266,15 +742,126 @@ def test_index_respects_gitignore(temp_db, resource_dir):
         assert "wagahai.txt" in basenames  # existing content
 
 
+def test_index_prunes_ignored_directories(temp_db, tmp_path):
+    d = tmp_path / "prune_resources"
+    (d / "node_modules" / "pkg").mkdir(parents=True)
+    (d / "src").mkdir()
+    (d / ".gitignore").write_text("node_modules/\n", encoding="utf-8")
+    (d / "node_modules" / "pkg" / "index.txt").write_text("vendored", encoding="utf-8")
+    (d / "src" / "main.txt").write_text("source", encoding="utf-8")
+
+    scanned = []
+    real_scandir = os.scandir
+
+    def recording_scandir(path):
+        scanned.append(path)
+        return real_scandir(path)
+
+    with (
+        patch("mcp_jp_fts.server.DB_PATH", temp_db),
+        patch("os.scandir", recording_scandir),
+    ):
+        server.index_directory(str(d))  # type: ignore
+        files = server.list_indexed_files()  # type: ignore
+
+    assert [os.path.basename(f) for f in files] == ["main.txt"]
+    assert not any("node_modules" in p for p in scanned)
+
+
+def test_ignore_matcher_matches_pathspec():
+    paths = [
+        "build/out.txt",
+        "src/build/x.txt",
+        "debug.log",
+        "src/a.py",
+        "docs/_build/i.txt",
+        "notes.txt",
+    ]
+    for lines in (
+        ["build/", "*.log", "/docs/_build/", "# comment", ""],
+        ["*.log", "!keep.log", "build/"],  # negation keeps pattern order significant
+        [],
+    ):
+        spec = server.pathspec.PathSpec.from_lines("gitignore", lines)
+        matcher = server.ignore_matcher(spec)
+        assert [matcher(p) for p in paths] == [spec.match_file(p) for p in paths]
+
+
+def test_has_text_extension():
+    assert server.has_text_extension("server.py")
+    assert server.has_text_extension("README.MD")
+    assert server.has_text_extension("Makefile")
+    assert server.has_text_extension(".bashrc")
+    assert not server.has_text_extension("image.png")
+    assert not server.has_text_extension("archive.tar.gz")
+    assert not server.has_text_extension("file.")
+
+
+def test_scan_failure_is_logged(tmp_path):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    server.logger.addHandler(handler)
+    try:
+        assert list(server.iter_files(str(tmp_path / "missing"))) == []
+    finally:
+        server.logger.removeHandler(handler)
+
+    assert len(records) == 1
+    assert records[0].levelno == logging.WARNING
+    assert "Failed to scan" in records[0].getMessage()
+
+
+def test_index_skips_hidden_entries(temp_db, resource_dir):
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        hidden_dir = os.path.join(resource_dir, ".git")
+        os.makedirs(hidden_dir)
+        with open(os.path.join(hidden_dir, "config.txt"), "w") as f:
+            f.write("hidden content")
+        with open(os.path.join(resource_dir, ".hidden.txt"), "w") as f:
+            f.write("hidden content")
+
+        server.index_directory(resource_dir)  # type: ignore
+
+        files = server.list_indexed_files()  # type: ignore
+        basenames = [os.path.basename(f) for f in files]
+
+        assert "config.txt" not in basenames
+        assert ".hidden.txt" not in basenames
+        assert "ginga.txt" in basenames  # subdirectories are still walked
+
+
+def test_index_skips_non_text_and_large_files(temp_db, resource_dir):
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        with open(os.path.join(resource_dir, "image.png"), "w") as f:
+            f.write("not really an image")
+        with open(os.path.join(resource_dir, "README"), "w") as f:
+            f.write("extensionless text")
+        with open(os.path.join(resource_dir, "large.txt"), "w") as f:
+            f.write("x" * 100)
+
+        with patch("mcp_jp_fts.server.MAX_FILE_BYTES", 99):
+            server.index_directory(resource_dir)  # type: ignore
+
+        files = server.list_indexed_files()  # type: ignore
+        basenames = [os.path.basename(f) for f in files]
+
+        assert "image.png" not in basenames
+        assert "large.txt" not in basenames
+        assert "README" in basenames
+        assert "wagahai.txt" in basenames
+
+
 def test_search_extension_filtering(temp_db, resource_dir):
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         # Create dummy files with different extensions
-        with open(os.path.join(resource_dir, "test.py"), "w") as f:
-            f.write("def func(): pass\n# 猫がいる")
-        with open(os.path.join(resource_dir, "test.md"), "w") as f:
-            f.write("# 猫について")
-        with open(os.path.join(resource_dir, "test.txt"), "w") as f:
-            f.write("猫のメモ")
+        write_files(
+            [
+                (os.path.join(resource_dir, "test.py"), "def func(): pass\n# 猫がいる"),
+                (os.path.join(resource_dir, "test.md"), "# 猫について"),
+                (os.path.join(resource_dir, "test.txt"), "猫のメモ"),
+            ]
+        )
 
         # Index
         server.index_directory(resource_dir)  # type: ignore
@@ -313,10 +900,7 @@ def test_incremental_indexing(temp_db, tmp_path):
         file_b = os.path.join(clean_dir, "b.txt")
 
         # 1. Initial State: a.txt, b.txt
-        with open(file_a, "w") as f:
-            f.write("content A")
-        with open(file_b, "w") as f:
-            f.write("content B")
+        write_files([(file_a, "content A"), (file_b, "content B")])
 
         # Initial Index
         res1 = server.index_directory(clean_dir)  # type: ignore
@@ -330,14 +914,10 @@ def test_incremental_indexing(temp_db, tmp_path):
         # Explicitly set mtime to be safely in the future
         future_mtime = time.time() + 10
         # Ensure content change too, though mtime is primary check
-        with open(file_a, "w") as f:
-            f.write("content A modified")
+        file_c = os.path.join(clean_dir, "c.txt")
+        write_files([(file_a, "content A modified"), (file_c, "content C")])
         os.utime(file_a, (future_mtime, future_mtime))
-            
         os.remove(file_b)
-        file_c = os.path.join(clean_dir, "c.txt")
-        with open(file_c, "w") as f:
-            f.write("content C")
 
         # Incremental Index
         res2 = server.index_directory(clean_dir)  # type: ignore
@@ -369,6 +949,59 @@ def test_incremental_indexing(temp_db, tmp_path):
         assert "Deleted 0" in res3
 
 
+def test_duplicate_content_tokenized_once(temp_db, tmp_path):
+    d = tmp_path / "dup_resources"
+    d.mkdir()
+    (d / "a.txt").write_text("吾輩は猫である", encoding="utf-8")
+    (d / "b.txt").write_text("吾輩は猫である", encoding="utf-8")
+    (d / "c.txt").write_text("東京タワー", encoding="utf-8")
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        # index_directory loads through documents, update_file through server
+        with (
+            patch(
+                "mcp_jp_fts.documents.load_document", wraps=documents.load_document
+            ) as load,
+            patch("mcp_jp_fts.server.load_document", load),
+        ):
+            server.index_directory(str(d))  # type: ignore
+            assert load.call_count == 2
+
+            # A copy added later reuses the tokens stored for the first one
+            (d / "copy.txt").write_text("吾輩は猫である", encoding="utf-8")
+            assert "Updated" in server.update_file(str(d / "copy.txt"))  # type: ignore
+            assert load.call_count == 2
+
+        results = server.search_documents("猫", limit=10)  # type: ignore
+
+    assert len(results) == 3
+    assert all(":1" in r and "吾輩は猫である" in r for r in results)
+
+
+def test_content_hash_describes_tokenized_bytes(temp_db, tmp_path):
+    """A file written between hashing and loading is stored under the digest of what was tokenized."""
+    d = tmp_path / "hash_resources"
+    d.mkdir()
+    for name in ("a.txt", "b.txt"):
+        (d / name).write_text("吾輩は猫である", encoding="utf-8")
+    stale = b"\x00" * 16  # the digest taken before the (simulated) write
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        with patch("mcp_jp_fts.server.file_digest", return_value=stale):
+            server.index_directory(str(d))  # type: ignore
+            (d / "c.txt").write_text("雪国", encoding="utf-8")
+            server.update_file(str(d / "c.txt"))  # type: ignore
+
+        with server.get_db() as conn:
+            rows = conn.execute(
+                "SELECT path, content_hash FROM documents_meta ORDER BY path"
+            ).fetchall()
+
+    assert len(rows) == 3
+    for path, content_hash in rows:
+        assert content_hash == server.file_digest(path)
+
+
 def test_update_file(temp_db, tmp_path):
     clean_dir = str(tmp_path / "update_resources")
     os.makedirs(clean_dir)
@@ -391,6 +1024,16 @@ def test_update_file(temp_db, tmp_path):
         results = server.search_documents("updated")  # type: ignore
         assert len(results) == 1
         assert "a.txt" in results[0]
+        # Nothing changed since the last update: the file is not re-read
+        with patch("mcp_jp_fts.server.load_document") as load:
+            res = server.update_file(file_a)  # type: ignore
+        assert "Skipped (unchanged)" in res
+        load.assert_not_called()
+
+        # The old row was replaced, not duplicated
+        assert server.search_documents("initial") == ["No matches found."]  # type: ignore
+        with server.get_db() as conn:
+            assert conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0] == 1
 
         # 3. Delete File & Update Single File
         os.remove(file_a)
@@ -402,7 +1045,18 @@ def test_update_file(temp_db, tmp_path):
         assert len(files) == 0
 
 
-def test_watch_mode(temp_db, tmp_path):
+def wait_for(pred, timeout=5.0, interval=0.05):
+    """Poll pred until it is truthy (watchdog and the debounce thread are asynchronous)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pred():
+            return
+        time.sleep(interval)
+    raise AssertionError(f"condition not met within {timeout}s")
+
+
+@pytest.mark.xdist_group("watch")
+def test_watch_mode(temp_db, tmp_path, watch_state):
     clean_dir = str(tmp_path / "watch_resources")
     os.makedirs(clean_dir)
 
@@ -416,10 +1070,10 @@ def test_watch_mode(temp_db, tmp_path):
         with open(file_a, "w") as f:
             f.write("I am being watched")
 
-        # Wait for watchdog (it might take a moment)
-        time.sleep(3)
-
-        # Verify Search
+        # Wait for watchdog (it might take a moment) and verify search
+        wait_for(
+            lambda: any("watch_me.txt" in r for r in server.search_documents("watched"))
+        )  # type: ignore
         results = server.search_documents("watched")  # type: ignore
         assert len(results) > 0
         assert "watch_me.txt" in results[0]
@@ -427,9 +1081,11 @@ def test_watch_mode(temp_db, tmp_path):
         # 2. Modify File
         with open(file_a, "w") as f:
             f.write("I changed")
-        time.sleep(2)
 
         # Verify Search Update
+        wait_for(
+            lambda: any("watch_me.txt" in r for r in server.search_documents("changed"))
+        )  # type: ignore
         results2 = server.search_documents("changed")  # type: ignore
         assert len(results2) > 0
         assert "watch_me.txt" in results2[0]
@@ -441,7 +1097,8 @@ def test_watch_mode(temp_db, tmp_path):
         server.WATCHED_PATHS.clear()
 
 
-def test_watch_directory_dedup(temp_db, tmp_path):
+@pytest.mark.xdist_group("watch")
+def test_watch_directory_dedup(temp_db, tmp_path, watch_state):
     clean_dir = str(tmp_path / "dedup_resources")
     os.makedirs(clean_dir)
 
@@ -459,14 +1116,111 @@ def test_watch_directory_dedup(temp_db, tmp_path):
         server.WATCHED_PATHS.clear()
 
 
+@pytest.mark.xdist_group("watch")
+def test_unwatch_directory_reuses_observer(temp_db, tmp_path, watch_state):
+    first = tmp_path / "watch_one"
+    second = tmp_path / "watch_two"
+    first.mkdir()
+    second.mkdir()
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        server.WATCHED_PATHS.clear()
+        try:
+            assert "Started watching" in server.watch_directory(str(first))  # type: ignore
+            running = server.observer
+            assert "Started watching" in server.watch_directory(str(second))  # type: ignore
+            assert server.observer is running
+
+            assert "Stopped watching" in server.unwatch_directory(str(first))  # type: ignore
+            assert "Not watching" in server.unwatch_directory(str(first))  # type: ignore
+            assert list(server.WATCHED_PATHS) == [str(second)]
+            assert str(first) not in server._watches and str(second) in server._watches
+
+            # Watching it again schedules a new watch on the same observer
+            assert "Started watching" in server.watch_directory(str(first))  # type: ignore
+            assert server.observer is running
+        finally:
+            server.observer.stop()
+            server.observer.join()
+            server.WATCHED_PATHS.clear()
+
+
+def test_watch_events_debounced(tmp_path):
+    from watchdog.events import FileModifiedEvent
+
+    handler = server.FTSHandler(str(tmp_path))
+    target = str(tmp_path / "note.txt")
+    with (
+        patch("mcp_jp_fts.server.WATCH_DEBOUNCE_SECONDS", 0.05),
+        patch("mcp_jp_fts.server._update_or_remove_file") as update,
+    ):
+        for _ in range(5):
+            handler.on_modified(FileModifiedEvent(target))
+        handler.on_modified(FileModifiedEvent(str(tmp_path / "note.txt.swp")))
+        handler.on_modified(FileModifiedEvent(str(tmp_path / "note.txt~")))
+        wait_for(lambda: update.called and handler._drainer is None)
+
+    update.assert_called_once_with(target)
+    assert handler._drainer is None
+
+
+def test_watch_drainer_survives_db_errors(temp_db, tmp_path):
+    from watchdog.events import FileDeletedEvent, FileModifiedEvent
+
+    handler = server.FTSHandler(str(tmp_path))
+    gone = str(tmp_path / "gone.txt")
+    note = tmp_path / "note.txt"
+    note.write_text("吾輩は猫である", encoding="utf-8")
+    real_remove = server._remove_documents
+
+    def locked_remove(conn, paths):
+        if paths == [gone]:
+            raise sqlite3.OperationalError("database is locked")
+        real_remove(conn, paths)
+
+    with (
+        patch("mcp_jp_fts.server.DB_PATH", temp_db),
+        patch("mcp_jp_fts.server.WATCH_DEBOUNCE_SECONDS", 0.05),
+        patch("mcp_jp_fts.server._remove_documents", locked_remove),
+    ):
+        assert "Failed to update" in server._update_or_remove_file(gone)
+
+        # A drainer that raises is replaced on the next event
+        with patch(
+            "mcp_jp_fts.server._update_or_remove_file", side_effect=RuntimeError
+        ):
+            handler.on_deleted(FileDeletedEvent(gone))
+            wait_for(lambda: handler._drainer is None)
+
+        handler.on_modified(FileModifiedEvent(str(note)))
+        wait_for(lambda: server.list_indexed_files() == [str(note)])  # type: ignore
+        wait_for(lambda: handler._drainer is None)
+    assert handler._pending == {}
+
+
+def test_watch_handler_gitignore(tmp_path):
+    spec = server.pathspec.PathSpec.from_lines("gitignore", ["build/", "*.log"])
+    handler = server.FTSHandler(str(tmp_path), spec)
+
+    assert handler._should_ignore(str(tmp_path / "build" / "out.txt"))
+    assert handler._should_ignore(str(tmp_path / "src" / "debug.log"))
+    assert not handler._should_ignore(str(tmp_path / "src" / "main.txt"))
+
+
 def test_search_xss_protection(temp_db, tmp_path):
     RESOURCE_DIR = str(tmp_path / "xss_resources")
     os.makedirs(RESOURCE_DIR)
 
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
         # Create a file with malicious content
-        with open(os.path.join(RESOURCE_DIR, "malicious.txt"), "w") as f:
-            f.write("Here is a <script>alert('XSS')</script> attack example")
+        write_files(
+            [
+                (
+                    os.path.join(RESOURCE_DIR, "malicious.txt"),
+                    "Here is a <script>alert('XSS')</script> attack example",
+                )
+            ]
+        )
 
         server.index_directory(RESOURCE_DIR)  # type: ignore
 
@@ -522,6 +1276,42 @@ def test_search_line_numbers_multibyte(temp_db, tmp_path):
         assert "multibyte.txt:3" in results2[0]
 
 
+def test_search_multiple_matches_line_numbers(temp_db, tmp_path):
+    """Test that every match in a file reports its own line number."""
+    d = tmp_path / "multi_match_resources"
+    d.mkdir()
+    (d / "multi.txt").write_text("東京\n大阪\n東京\n名古屋\n東京", encoding="utf-8")
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        server.index_directory(str(d))  # type: ignore
+        results = server.search_documents("東京")  # type: ignore
+
+    assert len(results) == 3
+    assert "multi.txt:1" in results[0]
+    assert "multi.txt:3" in results[1]
+    assert "multi.txt:5" in results[2]
+
+
+def test_search_line_numbers_from_stored_table(temp_db, tmp_path):
+    """Line numbers come from the index, so a late match does not need the file prefix."""
+    d = tmp_path / "late_match_resources"
+    d.mkdir()
+    p = d / "late.txt"
+    p.write_text("filler line\n" * 10000 + "東京タワー", encoding="utf-8")
+
+    with patch("mcp_jp_fts.server.DB_PATH", temp_db):
+        server.index_directory(str(d))  # type: ignore
+        with server.get_db() as conn:
+            blob = conn.execute("SELECT line_offsets FROM documents_meta").fetchone()[0]
+        assert len(server.token_offsets_view(blob)) == 10000
+
+        results = server.search_documents("東京")  # type: ignore
+
+    assert len(results) == 1
+    assert "late.txt:10001" in results[0]
+    assert "東京タワー" in results[0]
+
+
 def test_search_crlf_offset(tmp_path, temp_db):
     d = tmp_path / "crlf_resources"
     d.mkdir()
@@ -545,9 +1335,8 @@ def test_search_crlf_offset(tmp_path, temp_db):
     assert line_found, "Could not find line 2 in results"
 
 
-def test_legacy_4byte_compatibility(temp_db, tmp_path):
+def test_legacy_4byte_compatibility(temp_db, db_conn, tmp_path):
     """Verify that we can still read 4-byte offset blobs (backward compatibility)"""
-    import sqlite3
     import struct
     
     clean_dir = str(tmp_path / "legacy_resources")
@@ -562,24 +1351,21 @@ def test_legacy_4byte_compatibility(temp_db, tmp_path):
         
     # Manually insert into DB with 4-byte packed offsets
     with patch("mcp_jp_fts.server.DB_PATH", temp_db):
-        conn = sqlite3.connect(temp_db)
-        
-        # 1. Insert FTS
-        conn.execute(
-            "INSERT INTO documents_fts (path, content, tokens) VALUES (?, ?, ?)",
-            (file_path, "Hello World", "Hello World")
-        )
-        
-        # 2. Insert Meta with 4-byte offsets
+        # 1. Insert Meta with 4-byte offsets
         offsets = [0, 6]
         packed_legacy = struct.pack(f"<{len(offsets)}I", *offsets)
-        
-        conn.execute(
-            "INSERT INTO documents_meta (path, mtime, scanned_at, token_locations) VALUES (?, ?, ?, ?)",
-            (file_path, os.path.getmtime(file_path), time.time(), packed_legacy)
-        )
-        conn.commit()
-        conn.close()
+
+        with server._transaction(db_conn):
+            cursor = db_conn.execute(
+                "INSERT INTO documents_meta (path, mtime, scanned_at, token_locations) VALUES (?, ?, ?, ?)",
+                (file_path, os.path.getmtime(file_path), time.time(), packed_legacy)
+            )
+
+            # 2. Insert FTS under the meta id
+            db_conn.execute(
+                "INSERT INTO documents_fts (rowid, path, tokens) VALUES (?, ?, ?)",
+                (cursor.lastrowid, file_path, "Hello World"),
+            )
         
         # 3. Search should succeed
         results = server.search_documents("World")
@@ -592,8 +1378,6 @@ def test_db_migration_v1_to_v2(tmp_path):
     Test that upgrading from v1 DB (no documents_meta) to v2 automatically clears
     the stale legacy index so that it can be cleanly re-indexed.
     """
-    import sqlite3
-    
     # 1. Create a "v1" database manually (documents_fts only)
     db_path = str(tmp_path / "v1_migration.db")
     conn = sqlite3.connect(db_path)
@@ -603,30 +1387,79 @@ def test_db_migration_v1_to_v2(tmp_path):
         ("/foo/bar.txt", "content", "tokens")
     )
     conn.commit()
+
+    # 2. Run server.init_db on the same connection. It detects the legacy index
+    # without metadata and clears documents_fts so everything is re-indexed.
+    server.init_db(conn)
+
+    # Check that documents_fts was cleared
+    count = conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0]
+    assert count == 0
+    conn.close()
+
+
+def test_db_migration_drops_content_column(tmp_path):
+    """
+    Test that an index which still stores the raw content column is rebuilt
+    without it, and its metadata is cleared so files get re-indexed.
+    """
+    db_path = str(tmp_path / "content_migration.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE VIRTUAL TABLE documents_fts USING fts5(path, content, tokens)")
+    conn.execute(
+        "CREATE TABLE documents_meta (path TEXT PRIMARY KEY, mtime REAL, scanned_at REAL, token_locations BLOB)"
+    )
+    conn.execute(
+        "INSERT INTO documents_fts (path, content, tokens) VALUES (?, ?, ?)",
+        ("/foo/bar.txt", "content", "tokens"),
+    )
+    conn.execute(
+        "INSERT INTO documents_meta (path, mtime, scanned_at) VALUES (?, ?, ?)",
+        ("/foo/bar.txt", 1000.0, 1000.0),
+    )
+    conn.commit()
+
+    server.init_db(conn)
+
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(documents_fts)")]
+    assert columns == ["path", "tokens"]
+    assert conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0] == 0
+    assert conn.execute("SELECT count(*) FROM documents_meta").fetchone()[0] == 0
+    conn.close()
+
+
+def test_db_migration_adds_meta_id(tmp_path):
+    """
+    Test that metadata without an explicit id is rebuilt, since FTS rowids
+    are keyed by documents_meta.id.
+    """
+    db_path = str(tmp_path / "meta_id_migration.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(server.FTS_TABLE_SQL)
+    conn.execute(
+        "CREATE TABLE documents_meta (path TEXT PRIMARY KEY, mtime REAL, scanned_at REAL, token_locations BLOB)"
+    )
+    conn.execute(
+        "INSERT INTO documents_fts (path, tokens) VALUES (?, ?)",
+        ("/foo/bar.txt", "tokens"),
+    )
+    conn.execute(
+        "INSERT INTO documents_meta (path, mtime, scanned_at) VALUES (?, ?, ?)",
+        ("/foo/bar.txt", 1000.0, 1000.0),
+    )
+    conn.commit()
+
+    server.init_db(conn)
+
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(documents_meta)")]
+    assert columns[0] == "id"
+    assert conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0] == 0
+    assert conn.execute("SELECT count(*) FROM documents_meta").fetchone()[0] == 0
     conn.close()
-    
-    # 2. Run server.init_db (via context manager or direct call)
-    # We patch DB_PATH to use our pre-populated DB
-    with patch("mcp_jp_fts.server.DB_PATH", db_path):
-        # We must initialize the DB to ensure tables exist (Alembic/init_db would normally do this)
-        # But here we are simulating an existing DB.
-        
-        # When we connect and run index_directory, it should detect the mismatch
-        # However, our current migration logic is:
-        # "Detected legacy index without metadata" -> DELETE FROM documents_fts
-        # This happens in init_db check.
-        
-        # So we need to ensure init_db is called.
-        # So we need to ensure init_db is called.
-        with sqlite3.connect(db_path) as conn:
-            server.init_db(conn) # This triggers the check
-            
-            # Check that documents_fts was cleared
-            count = conn.execute("SELECT count(*) FROM documents_fts").fetchone()[0]
-            assert count == 0
 
 
-def test_get_index_stats(temp_db, tmp_path):
+@pytest.mark.xdist_group("watch")
+def test_get_index_stats(temp_db, tmp_path, watch_state):
     """Test get_index_stats tool"""
     import json
     